@@ -0,0 +1,320 @@
+"""Offline end-to-end benchmark of the mensa bot.
+
+Starts a local HTTP stand-in for studentenwerk-magdeburg.de and unifilm.de, a fake Matrix client that records
+every send_message call and a SQLite database, then drives fetch_menus, autofetch_menus, hunger_handler and
+notify_subscribers and reports latency percentiles and throughput.
+
+Usage (from the repository root):
+    python -m benchmarks.e2e --rooms 500 --days 10 --canteens 5
+    python -m benchmarks.e2e --pages recorded/ --canteen unicampus   # serve recorded html files
+
+With --pages the bot fetches the canteens of the plugin from recorded pages instead of generated ones, every
+canteen with a recording in the directory or the ones given by --canteen. A recording is named after the path of
+its URL below the first segment, e.g. recorded/mensa-unicampus-speiseplan-oben.html and
+recorded/mensa-stendal-speiseplan.html, and a missing recording of a benchmarked canteen is an error.
+The movie calendar is read from recorded/MD_HiD.html if it exists and generated otherwise.
+"""
+import argparse
+import asyncio
+import io
+import logging
+import os
+import statistics
+import tempfile
+import time
+from datetime import date, timedelta
+from typing import Awaitable, Callable, Dict, List
+
+import aiohttp
+from aiohttp import web
+from mautrix.util.config import RecursiveDict
+from ruamel.yaml import YAML
+from sqlalchemy import create_engine
+from yarl import URL
+
+import ovgumensabot.mensabot as mensabot
+from ovgumensabot.mensabot import MensaBot, Config
+
+BASE_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "base-config.yaml")
+WEEKDAYS = ["Montag", "Dienstag", "Mittwoch", "Donnerstag", "Freitag", "Samstag", "Sonntag"]
+
+
+def generate_menu_page(first_day: date, days: int, meals: int, canteen: str) -> str:
+    """Return a canteen page in the structure of the studentenwerk speiseplan pages."""
+    tables = []
+    for offset in range(days):
+        day = first_day + timedelta(days=offset)
+        rows = "".join(f"<tr><td><strong>{canteen} Gericht {i}</strong><br/><span class=\"zusatz\">(1,2,3)</span>"
+                       f"<br/>{i + 1},50 | {i + 3},00 | {i + 4},50</td><td><img src=\"icon.png\"/></td></tr>"
+                       for i in range(meals))
+        rows += "<tr><td>Beilagen: Reis, Pommes frites, Salat</td></tr>"
+        tables.append(f"<table><thead><tr><td>{WEEKDAYS[day.weekday()]}, {day.strftime('%d.%m.%Y')}</td></tr>"
+                      f"</thead><tbody>{rows}</tbody></table>")
+    navigation = "<div class=\"nav\"><a href=\"#\">Link</a></div>" * 200
+    return (f"<html><head><title>{canteen}</title></head><body>{navigation}"
+            f"<div class=\"mensa\">{''.join(tables)}</div></body></html>")
+
+
+def generate_movie_page(first_day: date, movies: int) -> str:
+    """Return a movie calendar in the structure of the unifilm.de page."""
+    rows = "".join(f"<div class=\"semester-film-row\">"
+                   f"<div class=\"film-row-text film-row-datum\">"
+                   f"Di {(first_day + timedelta(days=7 * i)).strftime('%d.%m.%Y')}</div>"
+                   f"<div class=\"film-row-text film-row-uhrzeit\">20:00 Uhr</div>"
+                   f"<div class=\"film-row-text film-row-titel\">Film {i} </div></div>" for i in range(movies))
+    return f"<html><body><div class=\"kino-detail-spielplan spielplan-thisSemester\">{rows}</div></body></html>"
+
+
+class StandInServer:
+    """Local HTTP server answering every upstream URL by its path, with ETag support."""
+    pages: Dict[str, str]
+    requests: int
+
+    def __init__(self, pages: Dict[str, str]) -> None:
+        self.pages = pages
+        self.requests = 0
+        self.runner = None
+        self.base_url = None
+
+    async def handle(self, req: web.Request) -> web.Response:
+        self.requests += 1
+        page = self.pages.get(req.path)
+        if page is None:
+            return web.Response(status=404)
+        etag = f'"{hash(page)}"'
+        if req.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(text=page, content_type="text/html", headers={"ETag": etag})
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/{path:.*}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = URL(f"http://127.0.0.1:{port}")
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+
+
+class StandInSession:
+    """aiohttp session that sends every request to the stand-in server, keeping the path of the URL."""
+
+    def __init__(self, session: aiohttp.ClientSession, base_url: URL) -> None:
+        self.session = session
+        self.base_url = base_url
+
+    def get(self, url: str, **kwargs):
+        return self.session.get(self.base_url.with_path(URL(url).path), **kwargs)
+
+    def request(self, method: str, url: str, **kwargs):
+        return self.session.request(method, self.base_url.with_path(URL(url).path), **kwargs)
+
+
+class FakeClient:
+    """Matrix client recording send_message calls, with a fixed homeserver latency."""
+    sent: List
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.sent = []
+
+    async def send_message(self, room_id, content) -> str:
+        await asyncio.sleep(self.latency)
+        self.sent.append((room_id, content))
+        return f"$event{len(self.sent)}"
+
+
+class FakeEvent:
+    """Message event of a command, recording responses."""
+
+    def __init__(self, room_id: str, client: FakeClient) -> None:
+        self.room_id = room_id
+        self.event_id = f"$command-{room_id}"
+        self.sender = "@benchmark:localhost"
+        self.client = client
+
+    async def respond(self, content) -> str:
+        return await self.client.send_message(self.room_id, content)
+
+
+def make_config(overrides: dict) -> Config:
+    yaml = YAML()
+    with open(BASE_CONFIG, encoding="utf8") as fp:
+        base = yaml.load(fp)
+    for key, value in overrides.items():
+        base[key] = value
+    config = Config(load=lambda: base, load_base=lambda: RecursiveDict(base, dict), save=lambda data: None)
+    config.load_and_update()
+    return config
+
+
+def make_bot(http, client: FakeClient, database_path: str, config: Config) -> MensaBot:
+    # the constructor of Plugin differs between maubot versions, so only the attributes used by the bot are set
+    bot = MensaBot.__new__(MensaBot)
+    bot.client = client
+    bot.loop = asyncio.get_event_loop()
+    bot.http = http
+    bot.id = "benchmark"
+    bot.log = logging.getLogger("benchmark.bot")
+    bot.config = config
+    bot.database = create_engine(f"sqlite:///{database_path}")
+    bot.webapp = None
+    return bot
+
+
+class Results:
+    """Latencies of all runs per scenario"""
+
+    def __init__(self) -> None:
+        self.latencies: Dict[str, List[float]] = {}
+        self.wall_times: Dict[str, float] = {}
+
+    async def measure(self, name: str, calls: List[Callable[[], Awaitable]], concurrency: int = 1) -> None:
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = self.latencies.setdefault(name, [])
+
+        async def timed(call: Callable[[], Awaitable]) -> None:
+            async with semaphore:
+                start = time.perf_counter()
+                await call()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(timed(call) for call in calls))
+        self.wall_times[name] = self.wall_times.get(name, 0) + time.perf_counter() - start
+
+    def report(self) -> str:
+        out = io.StringIO()
+        out.write(f"{'scenario':<28}{'runs':>6}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+                  f"{'ops/s':>10}\n")
+        for name, latencies in self.latencies.items():
+            ordered = sorted(latencies)
+            quantiles = statistics.quantiles(ordered, n=100, method="inclusive") if len(ordered) > 1 else ordered * 99
+            throughput = len(ordered) / self.wall_times[name] if self.wall_times[name] else float("inf")
+            out.write(f"{name:<28}{len(ordered):>6}{quantiles[49] * 1000:>10.2f}{quantiles[89] * 1000:>10.2f}"
+                      f"{quantiles[98] * 1000:>10.2f}{ordered[-1] * 1000:>10.2f}{throughput:>10.1f}\n")
+        return out.getvalue()
+
+
+def recording_name(url: str) -> str:
+    """Return the file name of the recording of a page, the path of its URL below the first segment."""
+    return "-".join(URL(url).path.strip("/").split("/")[1:]) + ".html"
+
+
+def recorded_canteens(directory: str) -> List[str]:
+    """Return the canteens of the plugin with at least one recorded page in a directory."""
+    return [canteen for canteen, urls in mensabot.CANTEENS.items()
+            if any(os.path.exists(os.path.join(directory, recording_name(url))) for url in urls)]
+
+
+def load_pages(args: argparse.Namespace, canteens: Dict[str, List[str]]) -> Dict[str, str]:
+    """Return the pages served by the stand-in server by path, recorded ones if args.pages is given.
+
+    @raise FileNotFoundError: if a page of a canteen or the given directory is not recorded
+    """
+    tomorrow = date.today() + timedelta(days=1)
+    pages = {}
+    for canteen, urls in canteens.items():
+        for url in urls:
+            if not args.pages:
+                pages[URL(url).path] = generate_menu_page(tomorrow, args.days, args.meals, canteen)
+                continue
+            recorded = os.path.join(args.pages, recording_name(url))
+            if not os.path.exists(recorded):
+                raise FileNotFoundError(f"no recording of {url} of canteen {canteen}, expected {recorded}")
+            with open(recorded, encoding="utf8") as fp:
+                pages[URL(url).path] = fp.read()
+    recorded = os.path.join(args.pages, recording_name(mensabot.HID_URL)) if args.pages else None
+    if recorded and os.path.exists(recorded):
+        with open(recorded, encoding="utf8") as fp:
+            pages[URL(mensabot.HID_URL).path] = fp.read()
+    else:
+        pages[URL(mensabot.HID_URL).path] = generate_movie_page(date.today(), 15)
+    return pages
+
+
+async def run(args: argparse.Namespace) -> None:
+    if args.pages:
+        names = args.canteen or recorded_canteens(args.pages)
+        if not names:
+            raise FileNotFoundError(f"no recorded canteen page in {args.pages}")
+        canteens = {canteen: mensabot.CANTEENS[canteen] for canteen in names}
+    else:
+        # the bot fetches the pages of the module level canteen list, one page per benchmark canteen
+        canteens = {f"benchmark-{i}": [f"https://www.studentenwerk-magdeburg.de/mensen-cafeterien/benchmark-{i}/"]
+                    for i in range(args.canteens)}
+        mensabot.CANTEENS.update(canteens)
+
+    server = StandInServer(load_pages(args, canteens))
+    await server.start()
+    client = FakeClient(args.send_latency / 1000)
+    results = Results()
+    database_path = os.path.join(tempfile.mkdtemp(prefix="mensabot-benchmark-"), "mensabot.db")
+
+    async with aiohttp.ClientSession() as session:
+        bot = make_bot(StandInSession(session, server.base_url), client, database_path,
+                       make_config({"min_fetch_interval": 0, "parser_pool": args.parser_pool,
+                                    "canteens": list(canteens)}))
+        await bot.start()
+        try:
+            await results.measure("fetch_menus (cold)", [bot.fetch_menus])
+            await results.measure("fetch_menus (unchanged)", [bot.fetch_menus] * args.repeat)
+
+            rooms = [f"!room{i}:localhost" for i in range(args.rooms)]
+            await bot.subscriptions.add_many({room_id: bot.canteens[i % len(bot.canteens)]
+                                              for i, room_id in enumerate(rooms)})
+
+            # recorded pages may hold past days only, so one keyword asks for the first stored day
+            first_day = await bot.db.get_first_menu_day(bot.canteens[0], date.min)
+            keywords = ["", "today", "tomorrow", "monday", "friday", first_day.strftime("%d.%m.%Y")]
+            hunger = MensaBot.hunger_handler.__mb_func__
+            await results.measure("hunger_handler", [
+                (lambda i=i: hunger(bot, FakeEvent(rooms[i % len(rooms)], client), keywords[i % len(keywords)]))
+                for i in range(args.commands)], concurrency=args.concurrency)
+
+            menus = await bot.db.get_menu_on_day(bot.canteens[0], first_day)
+
+            async def notify() -> None:
+                # every run pushes the menu again instead of being skipped as already sent
+                bot.notified_versions.clear()
+                await bot.notify_subscribers(menus[0])
+
+            await results.measure("notify_subscribers", [notify] * args.repeat)
+            await results.measure("autofetch_menus", [bot.autofetch_menus])
+        finally:
+            await bot.stop()
+            await server.stop()
+
+    print(f"canteens={','.join(canteens)} days={args.days} meals={args.meals} rooms={args.rooms} "
+          f"commands={args.commands} concurrency={args.concurrency} send_latency={args.send_latency}ms "
+          f"parser_pool={args.parser_pool}")
+    print(results.report())
+    print(f"upstream requests: {server.requests}, messages sent: {len(client.sent)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the mensa bot")
+    parser.add_argument("--canteens", type=int, default=2, help="number of generated canteen pages")
+    parser.add_argument("--days", type=int, default=5, help="days per canteen page")
+    parser.add_argument("--meals", type=int, default=8, help="meals per day and canteen")
+    parser.add_argument("--rooms", type=int, default=100, help="number of subscribed rooms")
+    parser.add_argument("--commands", type=int, default=200, help="number of !hunger commands")
+    parser.add_argument("--concurrency", type=int, default=20, help="!hunger commands in flight")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of the repeated scenarios")
+    parser.add_argument("--send-latency", type=float, default=5, help="fake homeserver latency in ms")
+    parser.add_argument("--pages", help="directory with recorded html pages")
+    parser.add_argument("--canteen", action="append", choices=list(mensabot.CANTEENS),
+                        help="canteen fetched from the recorded pages, repeatable (default: all recorded ones)")
+    parser.add_argument("--parser-pool", choices=["thread", "process"], default="thread",
+                        help="pool the pages are parsed in")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Equivalence check and benchmark of the menu parser.
+
+Parses saved canteen pages with get_menus_from_page and with its reference implementation
+get_menus_from_page_reference, fails if they return different menus and reports the parse time and peak allocation
+of both. Without arguments the fixtures in benchmarks/fixtures are used, synthetic pages in the markup of both
+Unicampus pages rather than recordings of the live site.
+
+Usage (from the repository root):
+    python -m benchmarks.parser
+    python -m benchmarks.parser recorded/mensa-unicampus-speiseplan-oben.html --number 50
+"""
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+from typing import List, Tuple
+
+from ovgumensabot.parser import get_menus_from_page, get_menus_from_page_reference
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+UNICAMPUS_FIXTURES = [os.path.join(FIXTURES, "mensa-unicampus-speiseplan-unten.html"),
+                      os.path.join(FIXTURES, "mensa-unicampus-speiseplan-oben.html")]
+
+
+def plain_menus(menus) -> List[Tuple]:
+    # last_updated is the time of parsing, so only days and meals are compared
+    return [(menu.day, [(str(meal.name), str(meal.price)) for meal in menu.meals]) for menu in menus]
+
+
+def check_equivalent(page: str) -> int:
+    """Compare the parser against the reference implementation on a given html source.
+
+    @param page: Html source string
+    @return: Number of menus parsed
+    @raise AssertionError: if the parsers return different menus or no menus at all
+    """
+    reference = plain_menus(get_menus_from_page_reference(page))
+    result = plain_menus(get_menus_from_page(page))
+    assert reference, "the reference parser found no menus"
+    for expected, actual in zip(reference, result):
+        assert expected == actual, f"menus differ:\n  reference {expected}\n  parser    {actual}"
+    assert len(reference) == len(result), f"{len(reference)} menus expected, {len(result)} parsed"
+    return len(result)
+
+
+def benchmark(page: str, number: int) -> None:
+    for parse in (get_menus_from_page_reference, get_menus_from_page):
+        tracemalloc.start()
+        parse(page)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        seconds = timeit.timeit(lambda: parse(page), number=number) / number
+        print(f"  {parse.__name__:<32}{seconds * 1000:>8.2f} ms per page{peak / 1024:>8.0f} KiB peak allocation")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Equivalence check and benchmark of the menu parser")
+    parser.add_argument("pages", nargs="*", default=UNICAMPUS_FIXTURES, help="saved canteen pages")
+    parser.add_argument("--number", type=int, default=20, help="parser runs to average")
+    args = parser.parse_args()
+
+    failed = False
+    for path in args.pages:
+        with open(path, encoding="utf8") as fp:
+            page = fp.read()
+        try:
+            menus = check_equivalent(page)
+        except AssertionError as e:
+            print(f"{path}: FAILED, {e}")
+            failed = True
+            continue
+        print(f"{path}: equivalent, {menus} menus")
+        benchmark(page, args.number)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
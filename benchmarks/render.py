@@ -0,0 +1,74 @@
+"""Micro-benchmark of rendering a menu message for every recipient of a push.
+
+Compares the previous rendering (string concatenation with +=, rendered again for every room) against
+MenuRenderer, which renders each menu version once and shares the content.
+
+Usage (from the repository root):
+    python -m benchmarks.render --meals 12 --rooms 500
+"""
+import argparse
+import timeit
+from datetime import date, datetime
+
+from mautrix.types import TextMessageEventContent, MessageType, Format
+
+from ovgumensabot.meal import Meal
+from ovgumensabot.menu import Menu
+from ovgumensabot.render import MenuRenderer
+
+
+def render_previous(menu: Menu) -> TextMessageEventContent:
+    """Rendering as done by post_menu before MenuRenderer."""
+    plain_text = ""
+    for meal in menu.meals:
+        plain_text += "\n----------\n" + str(meal)
+    body = f"Speiseplan für {menu.day.strftime('%A, %d.%m.%Y')}:{plain_text}"
+    html = ""
+    for meal in menu.meals:
+        html += "<hr><br><strong>" + meal.name + "</strong><br>" + meal.price
+    formatted_body = f"<h3>Speiseplan für {menu.day.strftime('%A, %d.%m.%Y')}:</h3>{html}"
+    content = TextMessageEventContent(msgtype=MessageType.NOTICE, format=Format.HTML,
+                                      body=f"{body}", formatted_body=f"{formatted_body}")
+    meals = {}
+    for i in range(len(menu.meals)):
+        meals[f'meal {i}'] = menu.meals.__getitem__(i).to_dict()
+    content["menu"] = meals
+    return content
+
+
+def make_menu(meals: int) -> Menu:
+    return Menu(day=date.today(), last_updated=datetime.now(),
+                meals=[Meal(name=f"Hähnchenbrust mit Paprikarahmsoße, Reis und Salat {i} (1,2,3,9,Gl,Sl)",
+                            price=f"{i + 2},40 | {i + 4},10 | {i + 5},00") for i in range(meals)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark of menu rendering")
+    parser.add_argument("--meals", type=int, default=12, help="meals per menu")
+    parser.add_argument("--rooms", type=int, default=500, help="recipients per push")
+    parser.add_argument("--number", type=int, default=20, help="pushes to average")
+    args = parser.parse_args()
+
+    menu = make_menu(args.meals)
+    assert render_previous(menu).serialize() == MenuRenderer().render(menu).serialize()
+
+    def push_previous():
+        for _ in range(args.rooms):
+            render_previous(menu)
+
+    def push_shared():
+        # a new version per push, as every push follows a change of the menu
+        renderer = MenuRenderer()
+        for _ in range(args.rooms):
+            renderer.render(menu)
+
+    print(f"meals={args.meals} rooms={args.rooms}")
+    for name, push in (("previous", push_previous), ("shared", push_shared)):
+        seconds = timeit.timeit(push, number=args.number) / args.number
+        print(f"{name:<10}{seconds * 1000:>10.3f} ms per push{seconds / args.rooms * 1e6:>10.2f} µs per room")
+    single = timeit.timeit(lambda: MenuRenderer().render(menu), number=1000) / 1000
+    print(f"{'render':<10}{single * 1000:>10.3f} ms per menu version")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Benchmark of the start of the mensa bot.
+
+Measures importing the plugin in a fresh interpreter, with the modules maubot loads anyway already imported,
+and start() followed by stop() on a new database and on a database holding menus and subscriptions.
+Also measures the first menu lookup after start, which needs no query if it is answered from the cache.
+
+Usage (from the repository root):
+    python -m benchmarks.startup --rooms 500 --days 365 --canteens 4
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from typing import List
+
+import aiohttp
+from sqlalchemy import create_engine
+
+import ovgumensabot.mensabot as mensabot
+from ovgumensabot.db import MenuDatabase
+from ovgumensabot.meal import Meal
+from ovgumensabot.menu import Menu
+from benchmarks.e2e import FakeClient, make_bot, make_config
+
+# modules imported by maubot before any plugin is loaded
+HOST_MODULES = "import aiohttp, maubot, mautrix, sqlalchemy"
+IMPORT_SCRIPT = f"""
+import sys, time
+{HOST_MODULES}
+start = time.perf_counter()
+import ovgumensabot.mensabot
+print(time.perf_counter() - start, "bs4" in sys.modules, "markdown" in sys.modules)
+"""
+
+
+def measure_import(repeat: int) -> None:
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], check=True, capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.split()
+        times.append(float(out[0]))
+    print(f"{'import':<14}{statistics.median(times) * 1000:>10.1f} ms median  "
+          f"bs4 loaded={out[1]} markdown loaded={out[2]}")
+
+
+def fill_database(path: str, canteens: List[str], rooms: int, days: int) -> None:
+    db = MenuDatabase(create_engine(f"sqlite:///{path}"))
+    first_day = date.today() - timedelta(days=days - 14)
+    db.upsert_menus([Menu(canteen=canteen, day=first_day + timedelta(days=i), last_updated=datetime.now(),
+                          meals=[Meal(name=f"Gericht {j} am Tag {i}", price=f"{j},50 | {j + 2},00 | {j + 3},00")
+                                 for j in range(8)])
+                     for canteen in canteens for i in range(days)])
+    db.insert_subscriptions([(f"!room{i}:example.org", canteens[i % len(canteens)]) for i in range(rooms)])
+    db.db.dispose()
+
+
+async def measure_start(name: str, paths: List[str], canteens: List[str]) -> None:
+    config = make_config({"canteens": canteens})
+    starts, lookups, stops = [], [], []
+    async with aiohttp.ClientSession() as http:
+        for path in paths:
+            bot = make_bot(http, FakeClient(0), path, config)
+            start = time.perf_counter()
+            await bot.start()
+            starts.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            await bot.db.get_menu_on_day(canteens[0], date.today())
+            lookups.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            await bot.stop()
+            stops.append(time.perf_counter() - start)
+            bot.database.dispose()
+    print(f"{name:<14}{statistics.median(starts) * 1000:>10.1f} ms median start"
+          f"{statistics.median(lookups) * 1000:>10.2f} ms first lookup{statistics.median(stops) * 1000:>10.1f} ms stop")
+
+
+async def run(args: argparse.Namespace) -> None:
+    canteens = [f"benchmark-{i}" for i in range(args.canteens)]
+    mensabot.CANTEENS.update({canteen: [f"http://127.0.0.1:9/{canteen}/"] for canteen in canteens})
+    with tempfile.TemporaryDirectory() as directory:
+        # a new file per run, so every run creates the schema
+        await measure_start("new database", [os.path.join(directory, f"new-{i}.db") for i in range(args.repeat)],
+                            canteens)
+        path = os.path.join(directory, "filled.db")
+        fill_database(path, canteens, args.rooms, args.days)
+        await measure_start("filled", [path] * args.repeat, canteens)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the plugin start")
+    parser.add_argument("--rooms", type=int, default=500, help="subscribed rooms in the filled database")
+    parser.add_argument("--days", type=int, default=365, help="stored days per canteen in the filled database")
+    parser.add_argument("--canteens", type=int, default=4, help="enabled canteens")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per measurement")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the logs of the bot")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    print(f"rooms={args.rooms} days={args.days} canteens={args.canteens}")
+    measure_import(args.repeat)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import datetime
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from ovgumensabot.menu import Menu
+
+# canteen and day of the cached menus
+MenuKey = Tuple[str, datetime.date]
+
+
+class MenuCache:
+    """Bounded in-memory cache of the menus of a canteen on a day with TTL and LRU eviction.
+    A day without menu is cached as an empty list. Safe to use from the database worker threads.
+
+    Menus read from the database are put with the generation taken before the read. A put is dropped if the key was
+    invalidated since, so a read racing with a write cannot bring back the menus the write replaced.
+    """
+    max_size: int
+    ttl: float
+    hits: int
+    misses: int
+    evictions: int
+    _entries: "OrderedDict[MenuKey, Tuple[float, List[Menu]]]"
+    _generation: int
+    _invalidated: "OrderedDict[MenuKey, int]"
+    _floor: int
+    _lock: threading.Lock
+
+    def __init__(self, max_size: int = 256, ttl: float = 3600) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        # generation of the last invalidation by key, keys dropped from here count as invalidated at _floor
+        self._invalidated = OrderedDict()
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: MenuKey) -> Optional[List[Menu]]:
+        """Return the cached menus of a canteen on a day or None if the day is not cached or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def generation(self) -> int:
+        """Return the current generation, to be passed to put() for menus read afterwards."""
+        with self._lock:
+            return self._generation
+
+    def put(self, key: MenuKey, menus: List[Menu], generation: int = None) -> None:
+        """Cache the menus of a canteen on a day.
+
+        @param key: Canteen and day
+        @param menus: Menus of the day, empty if there is none
+        @param generation: Generation taken before the menus were read, they are dropped if the key was invalidated
+        since. None to put unconditionally.
+        """
+        with self._lock:
+            if generation is not None and max(self._invalidated.get(key, 0), self._floor) > generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, menus)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: MenuKey) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generation += 1
+            self._invalidated[key] = self._generation
+            self._invalidated.move_to_end(key)
+            while len(self._invalidated) > self.max_size:
+                self._floor = self._invalidated.popitem(last=False)[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self._invalidated.clear()
+            self._floor = self._generation
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
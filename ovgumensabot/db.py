@@ -1,114 +1,549 @@
+import asyncio
 import datetime
 import logging
-from typing import List, Iterator
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Iterable, List, Iterator, Optional, Tuple, Union
 
-from sqlalchemy import (Column, String, DateTime, Date, ForeignKey, Table, MetaData,
-                        select, func)
+import pytz
+from sqlalchemy import (Column, String, DateTime, Date, Integer, ForeignKeyConstraint, Index, Table, MetaData,
+                        and_, column, literal, select, table, text, func, inspect)
 from sqlalchemy.engine.base import Engine
 
+from ovgumensabot.cache import MenuCache
 from ovgumensabot.meal import Meal
-from ovgumensabot.menu import Menu
+from ovgumensabot.menu import Menu, MenuChanges
+from ovgumensabot.metrics import DB_QUERY_SECONDS
+from ovgumensabot.search import MealIndex, SearchResult, normalize
+
+
+# canteen of menus and subscriptions stored before the canteen dimension was added
+LEGACY_CANTEEN = "unicampus"
+# version of the schema created by MenuDatabase, increased with every change that needs a migration
+# 1: schema_version table, 2: meals.position
+SCHEMA_VERSION = 2
 
 
 class MenuDatabase:
     menus: Table
     meals: Table
     subscriptions: Table
+    movies: Table
+    jobs: Table
+    schema_version: Table
     db: Engine
+    cache: MenuCache
+    search_index: MealIndex
 
-    def __init__(self, db: Engine) -> None:
+    def __init__(self, db: Engine, cache: MenuCache = None) -> None:
         self.db = db
+        self.cache = cache if cache is not None else MenuCache()
+        self.search_index = MealIndex()
 
         meta = MetaData()
         meta.bind = db
 
         self.menus = Table("menus", meta,
+                           Column("canteen", String(255), primary_key=True),
                            Column("day", Date, primary_key=True),
                            Column("last_updated", DateTime, nullable=False))
 
         self.meals = Table("meals", meta,
-                           Column("menu_day", Date, ForeignKey("menus.day", ondelete="CASCADE", primary_key=True)),
+                           Column("canteen", String(255), nullable=False),
+                           Column("menu_day", Date, nullable=False),
                            Column("price", String(255), nullable=False),
-                           Column("name", String(255), nullable=False))
+                           Column("name", String(255), nullable=False),
+                           # index of the meal in the upstream menu, meals are read in this order
+                           Column("position", Integer, nullable=False, server_default="0"),
+                           ForeignKeyConstraint(["canteen", "menu_day"], ["menus.canteen", "menus.day"],
+                                                ondelete="CASCADE"),
+                           Index("ix_meals_canteen_menu_day", "canteen", "menu_day"))
 
         self.subscriptions = Table("subscriptions", meta,
-                                   Column("room_id", String(255), primary_key=True))
+                                   Column("room_id", String(255), primary_key=True),
+                                   Column("canteen", String(255), nullable=False, server_default=LEGACY_CANTEEN))
+
+        self.movies = Table("movies", meta,
+                            Column("start", DateTime, primary_key=True),
+                            Column("title", String(255), nullable=False))
+
+        self.jobs = Table("jobs", meta,
+                          Column("name", String(255), primary_key=True),
+                          Column("last_run", DateTime, nullable=False))
+
+        self.schema_version = Table("schema_version", meta,
+                                    Column("version", Integer, nullable=False))
 
-        meta.create_all()
+        self._migrate(meta)
 
-    def upsert_menu(self, menu: Menu) -> bool:
-        logging.getLogger("maubot").info(f"Inserted menu from {menu.day} into database.")
+    def _migrate(self, meta: MetaData) -> None:
+        """Bring the schema to SCHEMA_VERSION. A database at that version is checked with two cheap queries
+        instead of inspecting every table.
+        """
+        with self.db.connect() as conn:
+            version = None
+            if self.db.dialect.has_table(conn, self.schema_version.name):
+                version = conn.execute(select([self.schema_version.c.version])).scalar()
+        if version == SCHEMA_VERSION:
+            return
+        logging.getLogger("maubot").info(f"Migrating database from schema version {version} to {SCHEMA_VERSION}.")
+        if version is None:
+            # databases without version are either empty or were created before the canteen dimension
+            self._migrate_canteens()
+            meta.create_all()
+        if version is None or version < 2:
+            self._migrate_meal_positions()
         with self.db.begin() as tx:
-            if self.menu_day_exists(menu):
-                tx.execute(self.menus.update()
-                           .where(self.menus.c.day == menu.day).values(day=menu.day, last_updated=menu.last_updated))
-                tx.execute(self.meals.delete().where(self.meals.c.menu_day == menu.day))
-                tx.execute(self.meals.insert(),
-                           [{"menu_day": menu.day, "price": meal.price,
-                             "name": meal.name}
-                            for meal in menu.meals])
-                return False  # menu was already existent
+            tx.execute(self.schema_version.delete())
+            tx.execute(self.schema_version.insert().values(version=SCHEMA_VERSION))
+
+    def _migrate_canteens(self) -> None:
+        """Move menus, meals and subscriptions stored before the canteen dimension to LEGACY_CANTEEN.
+        The primary key of menus changes, so menus and meals are copied aside, recreated and filled again.
+        """
+        inspector = inspect(self.db)
+        tables = inspector.get_table_names()
+        if "menus" not in tables or any(column["name"] == "canteen" for column in inspector.get_columns("menus")):
+            return
+        logging.getLogger("maubot").info(f"Migrating menus to canteen {LEGACY_CANTEEN}.")
+        with self.db.begin() as tx:
+            tx.execute(text("CREATE TABLE menus_legacy AS SELECT day, last_updated FROM menus"))
+            tx.execute(text("CREATE TABLE meals_legacy AS SELECT menu_day, price, name FROM meals"))
+            tx.execute(text("DROP TABLE meals"))
+            tx.execute(text("DROP TABLE menus"))
+            self.menus.create(tx)
+            self.meals.create(tx)
+            tx.execute(self.menus.insert().from_select(
+                ["canteen", "day", "last_updated"],
+                select([literal(LEGACY_CANTEEN), column("day"), column("last_updated")])
+                .select_from(table("menus_legacy"))))
+            tx.execute(self.meals.insert().from_select(
+                ["canteen", "menu_day", "price", "name"],
+                select([literal(LEGACY_CANTEEN), column("menu_day"), column("price"), column("name")])
+                .select_from(table("meals_legacy"))))
+            tx.execute(text("DROP TABLE meals_legacy"))
+            tx.execute(text("DROP TABLE menus_legacy"))
+            if "subscriptions" in tables and not any(column["name"] == "canteen"
+                                                     for column in inspector.get_columns("subscriptions")):
+                tx.execute(text(f"ALTER TABLE subscriptions "
+                                f"ADD COLUMN canteen VARCHAR(255) NOT NULL DEFAULT '{LEGACY_CANTEEN}'"))
+
+    def _migrate_meal_positions(self) -> None:
+        """Add meals.position and number the stored meals of every day in the order they are read.
+        Rows have no key to update them by, so all meals are written again in one transaction.
+        """
+        if not any(column["name"] == "position" for column in inspect(self.db).get_columns("meals")):
+            logging.getLogger("maubot").info("Adding meal positions.")
+            self.db.execute(text("ALTER TABLE meals ADD COLUMN position INTEGER NOT NULL DEFAULT 0"))
+        with self.db.begin() as tx:
+            positions = Counter()
+            rows = []
+            for canteen, menu_day, price, name in tx.execute(select([self.meals.c.canteen, self.meals.c.menu_day,
+                                                                     self.meals.c.price, self.meals.c.name])):
+                rows.append({"canteen": canteen, "menu_day": menu_day, "price": price, "name": name,
+                             "position": positions[(canteen, menu_day)]})
+                positions[(canteen, menu_day)] += 1
+            if rows:
+                tx.execute(self.meals.delete())
+                tx.execute(self.meals.insert(), rows)
+
+    def upsert_menu(self, menu: Menu) -> MenuChanges:
+        """Write a menu, issuing only the inserts, updates and deletes needed to turn the stored meals into the given
+        ones position by position, so a changed meal keeps its place. Nothing is written if the meals did not change.
+        Every write stores the current time as last_updated, also on the given menu, so it identifies the version of
+        the meals: merged menus keep the last_updated of their first page, which may not have changed.
+
+        @param menu: Menu to write
+        @return: Changes compared to the stored menu
+        """
+        with self.db.begin() as tx:
+            stored_meals = {row[0]: (row[1], row[2]) for row in tx.execute(
+                select([self.meals.c.position, self.meals.c.name, self.meals.c.price])
+                .where(and_(self.meals.c.canteen == menu.canteen, self.meals.c.menu_day == menu.day)))}
+            incoming_meals = {position: (meal.name, meal.price) for position, meal in enumerate(menu.meals)}
+            new = tx.execute(select([func.count()]).select_from(self.menus)
+                             .where(and_(self.menus.c.canteen == menu.canteen,
+                                         self.menus.c.day == menu.day))).scalar() == 0
+            stored = Counter(stored_meals.values())
+            incoming = Counter(incoming_meals.values())
+            changes = diff_meals(menu.canteen, menu.day, stored, incoming)
+            changes.new = new
+            # meals that only moved are written too, but are no change worth a notification
+            if not changes.changed and stored_meals == incoming_meals:
+                return changes
+
+            menu.last_updated = datetime.datetime.now()
+            if new:
+                tx.execute(self.menus.insert().values(canteen=menu.canteen, day=menu.day,
+                                                      last_updated=menu.last_updated))
             else:
-                tx.execute(self.menus.insert()
-                           .values(day=menu.day, last_updated=menu.last_updated))
-                tx.execute(self.meals.insert(),
-                           [{"menu_day": menu.day, "price": meal.price,
-                             "name": meal.name}
-                            for meal in menu.meals])
-                return True  # menu is new
-
-    def add_meals_to_menu(self, menu: Menu):
-        logging.getLogger("maubot").info(f"Add meals to menu from {menu.day}.")
-        if self.menu_day_exists(menu):
-            self.db.execute(self.meals.insert(),
-                            [{"menu_day": menu.day, "price": meal.price,
-                              "name": meal.name}
-                             for meal in menu.meals])
-
-    def subscriptions_not_empty(self) -> bool:
-        rows = self.db.execute(select([func.count()]).select(self.subscriptions)).scalar()
-        return rows and rows > 0
-
-    def subscription_exists(self, room_id: str) -> bool:
-        rows = self.db.execute(
-            select([func.count()]).select(self.subscriptions).where(self.subscriptions.c.room_id == room_id)).scalar()
-        return rows and rows > 0
-
-    def menu_day_exists(self, menu: Menu) -> bool:
-        rows = self.db.execute(select([func.count()]).select(self.menus).where(self.menus.c.day == menu.day)).scalar()
-        return rows and rows > 0
-
-    def get_menu_on_day(self, day: datetime.date) -> Iterator[Menu]:
-        logging.getLogger("maubot").info(f"Search for day {day}")
-        menu_rows = self.db.execute(select([self.menus]).where(self.menus.c.day.like(day)))
-        return self._rows_to_menus(menu_rows)
-
-    def get_latest_menu(self) -> Iterator[Menu]:
-        menu_row = self.db.execute(select([self.menus]).order_by(self.menus.c.last_updated.desc()).limit(1))
-        logging.getLogger("maubot").info(f"first menu_row {menu_row}")
-        return self._rows_to_menus(menu_row)
-
-    def _rows_to_menus(self, menu_rows) -> Iterator[Menu]:
+                tx.execute(self.menus.update()
+                           .where(and_(self.menus.c.canteen == menu.canteen, self.menus.c.day == menu.day))
+                           .values(last_updated=menu.last_updated))
+            day_meals = and_(self.meals.c.canteen == menu.canteen, self.meals.c.menu_day == menu.day)
+            for position, (name, price) in incoming_meals.items():
+                if position in stored_meals and stored_meals[position] != (name, price):
+                    tx.execute(self.meals.update().where(and_(day_meals, self.meals.c.position == position))
+                               .values(name=name, price=price))
+            inserted = [{"canteen": menu.canteen, "menu_day": menu.day, "price": price, "name": name,
+                         "position": position}
+                        for position, (name, price) in incoming_meals.items() if position not in stored_meals]
+            if inserted:
+                tx.execute(self.meals.insert(), inserted)
+            if len(stored_meals) > len(incoming_meals):
+                tx.execute(self.meals.delete().where(and_(day_meals, self.meals.c.position >= len(incoming_meals))))
+        self.cache.invalidate((menu.canteen, menu.day))
+        incoming_names = {normalize(name) for name, price in incoming}
+        self.search_index.remove(menu.canteen, menu.day,
+                                 {name for name, price in stored if normalize(name) not in incoming_names})
+        self.search_index.add(menu.canteen, menu.day, {name for name, price in incoming})
+        logging.getLogger("maubot").info(f"Updated menu of {menu.canteen} from {menu.day} in database: "
+                                         f"{len(changes.added)} added, {len(changes.removed)} removed, "
+                                         f"{len(changes.price_changed)} price changed.")
+        return changes
+
+    def upsert_menus(self, menus: List[Menu]) -> List[MenuChanges]:
+        """Upsert several menus with a single call, see upsert_menu()."""
+        return [self.upsert_menu(menu) for menu in menus]
+
+    def get_menu_on_day(self, canteen: str, day: datetime.date) -> Iterator[Menu]:
+        logging.getLogger("maubot").info(f"Search for day {day} in {canteen}")
+        menus = self.cache.get((canteen, day))
+        if menus is None:
+            menus = self.load_menu_on_day(canteen, day)
+        return iter(menus)
+
+    def load_menu_on_day(self, canteen: str, day: datetime.date) -> List[Menu]:
+        """Read the menus of a day from the database, bypassing and refilling the cache."""
+        generation = self.cache.generation()
+        menus = list(self.get_menus_between(canteen, day, day))
+        self.cache.put((canteen, day), menus, generation)
+        return menus
+
+    def warm_cache(self, canteens: List[str], first_day: datetime.date, last_day: datetime.date) -> None:
+        """Load all days from first_day to last_day (inclusive) of the given canteens into the cache
+        with a single read."""
+        generation = self.cache.generation()
+        self._fill_cache(canteens, first_day, last_day, self.get_menus_between(canteens, first_day, last_day),
+                         generation)
+
+    def warm_start(self, canteens: List[str], first_day: datetime.date,
+                   last_day: datetime.date) -> List[Tuple[str, str]]:
+        """Load everything needed to answer commands right after start on one connection:
+        the menus from first_day to last_day (inclusive) into the cache, with meals joined in the same query,
+        and all subscriptions.
+
+        @return: (room_id, canteen) of all subscriptions
+        """
+        generation = self.cache.generation()
+        with self.db.connect() as conn:
+            subscriptions = [tuple(row) for row in conn.execute(
+                select([self.subscriptions.c.room_id, self.subscriptions.c.canteen])).fetchall()]
+            rows = conn.execute(
+                select([self.menus.c.canteen, self.menus.c.day, self.menus.c.last_updated,
+                        self.meals.c.price, self.meals.c.name])
+                .select_from(self.menus.outerjoin(self.meals, and_(self.meals.c.canteen == self.menus.c.canteen,
+                                                                   self.meals.c.menu_day == self.menus.c.day)))
+                .where(and_(self.menus.c.canteen.in_(canteens), self.menus.c.day.between(first_day, last_day)))
+                .order_by(self.menus.c.canteen, self.menus.c.day, self.meals.c.position)).fetchall()
+        menus = []
+        key = None
+        for canteen, day, last_updated, price, name in rows:
+            if (canteen, day) != key:
+                key = (canteen, day)
+                menus.append(Menu(canteen=canteen, day=day, last_updated=last_updated, meals=[]))
+            # days without meals have one row with NULL meal columns
+            if name is not None:
+                menus[-1].meals.append(Meal(menu_day=day, price=price, name=name))
+        self._fill_cache(canteens, first_day, last_day, menus, generation)
+        return subscriptions
+
+    def _fill_cache(self, canteens: List[str], first_day: datetime.date, last_day: datetime.date,
+                    menus: Iterable[Menu], generation: int) -> None:
+        menus_by_key = {(menu.canteen, menu.day): [menu] for menu in menus}
+        for canteen in canteens:
+            day = first_day
+            while day <= last_day:
+                self.cache.put((canteen, day), menus_by_key.get((canteen, day), []), generation)
+                day += datetime.timedelta(days=1)
+        logging.getLogger("maubot").info(f"Warmed menu cache from {first_day} to {last_day}: {self.cache.stats()}")
+
+    def get_menus_between(self, canteens: Union[str, List[str]], first_day: datetime.date,
+                          last_day: datetime.date) -> Iterator[Menu]:
+        """Return all menus of one or more canteens from first_day to last_day (inclusive),
+        ordered by canteen and day. Needs two queries, independent of the number of canteens and days.
+        """
+        canteens = [canteens] if isinstance(canteens, str) else canteens
+        logging.getLogger("maubot").info(f"Search for days {first_day} to {last_day} in {', '.join(canteens)}")
+        menu_rows = self.db.execute(select([self.menus])
+                                    .where(and_(self.menus.c.canteen.in_(canteens),
+                                                self.menus.c.day.between(first_day, last_day)))
+                                    .order_by(self.menus.c.canteen, self.menus.c.day)).fetchall()
+        if not menu_rows:
+            return iter([])
+        meal_rows = self.db.execute(select([self.meals])
+                                    .where(and_(self.meals.c.canteen.in_(canteens),
+                                                self.meals.c.menu_day.between(first_day, last_day)))
+                                    .order_by(self.meals.c.position))
+        return self._rows_to_menus(menu_rows, meal_rows)
+
+    @staticmethod
+    def _rows_to_menus(menu_rows, meal_rows) -> Iterator[Menu]:
+        meals_by_key = defaultdict(list)
+        for meal_row in meal_rows:
+            meals_by_key[(meal_row.canteen, meal_row.menu_day)].append(
+                Meal(menu_day=meal_row.menu_day, price=meal_row.price, name=meal_row.name))
         for menu_row in menu_rows:
-            logging.getLogger("maubot").info(f"menu_row {menu_row}")
-            meal_rows = self.db.execute(select([self.meals]).where(self.meals.c.menu_day == menu_row[0]))
-            meals_of_the_day = []
-            for meal_row in meal_rows:
-                meals_of_the_day.append(Meal(menu_day=meal_row[0], price=meal_row[1], name=meal_row[2]))
-            yield Menu(day=menu_row[0], last_updated=menu_row[1], meals=meals_of_the_day)
+            yield Menu(canteen=menu_row.canteen, day=menu_row.day, last_updated=menu_row.last_updated,
+                       meals=meals_by_key[(menu_row.canteen, menu_row.day)])
+
+    def insert_subscription(self, room_id: str, canteen: str) -> None:
+        self.db.execute(self.subscriptions.insert().values(room_id=room_id, canteen=canteen))
+
+    def update_subscription(self, room_id: str, canteen: str) -> None:
+        self.db.execute(self.subscriptions.update()
+                        .where(self.subscriptions.c.room_id == room_id).values(canteen=canteen))
+
+    def insert_subscriptions(self, subscriptions: List[Tuple[str, str]], batch_size: int = 500) -> None:
+        """Insert many (room_id, canteen) subscriptions in one transaction, batch_size rows per statement."""
+        with self.db.begin() as tx:
+            for i in range(0, len(subscriptions), batch_size):
+                tx.execute(self.subscriptions.insert(), [{"room_id": room_id, "canteen": canteen}
+                                                         for room_id, canteen in subscriptions[i:i + batch_size]])
 
-    def insert_subscription(self, room_id: str) -> None:
-        self.db.execute(self.subscriptions.insert().values(room_id=room_id))
+    def update_subscriptions(self, subscriptions: List[Tuple[str, str]], batch_size: int = 500) -> None:
+        """Change the canteen of many (room_id, canteen) subscriptions in one transaction,
+        with one statement per canteen and batch_size rooms."""
+        rooms_by_canteen = defaultdict(list)
+        for room_id, canteen in subscriptions:
+            rooms_by_canteen[canteen].append(room_id)
+        with self.db.begin() as tx:
+            for canteen, room_ids in rooms_by_canteen.items():
+                for i in range(0, len(room_ids), batch_size):
+                    tx.execute(self.subscriptions.update()
+                               .where(self.subscriptions.c.room_id.in_(room_ids[i:i + batch_size]))
+                               .values(canteen=canteen))
 
-    def get_subscriptions(self) -> List:
-        rows = self.db.execute(self.subscriptions.select())
-        for row in rows:
-            yield row[0]
+    def get_all_subscriptions(self) -> List[Tuple[str, str]]:
+        """Return (room_id, canteen) of all subscriptions."""
+        return [(row[0], row[1]) for row in self.db.execute(select([self.subscriptions.c.room_id,
+                                                                    self.subscriptions.c.canteen]))]
 
     def delete_subscription(self, room_id: str) -> None:
         self.db.execute(self.subscriptions.delete().where(self.subscriptions.c.room_id == room_id))
 
-    def get_menu_days(self) -> Iterator[datetime.date]:
-        rows = self.db.execute(select([self.menus.c.day]))
-        for row in rows:
-            yield row[0]
+    def delete_subscriptions(self, room_ids: List[str], batch_size: int = 500) -> None:
+        """Delete the subscriptions of many rooms in one transaction, batch_size rooms per statement."""
+        with self.db.begin() as tx:
+            for i in range(0, len(room_ids), batch_size):
+                tx.execute(self.subscriptions.delete()
+                           .where(self.subscriptions.c.room_id.in_(room_ids[i:i + batch_size])))
+
+    def get_first_menu_day(self, canteen: str, from_day: datetime.date) -> Optional[datetime.date]:
+        """Return the first day with a menu of a canteen on or after from_day.
+        Uses the (canteen, day) primary key index of menus.
+        """
+        return self.db.execute(select([self.menus.c.day])
+                               .where(and_(self.menus.c.canteen == canteen, self.menus.c.day >= from_day))
+                               .order_by(self.menus.c.day).limit(1)).scalar()
+
+    def prune_menus(self, before: datetime.date, batch_size: int = 500) -> int:
+        """Delete all menus and meals of all canteens before a given day in batches of batch_size days,
+        one transaction each.
+
+        @return: Number of deleted menus
+        """
+        deleted = 0
+        while True:
+            with self.db.begin() as tx:
+                days = [row[0] for row in tx.execute(select([self.menus.c.day]).distinct()
+                                                     .where(self.menus.c.day < before)
+                                                     .order_by(self.menus.c.day).limit(batch_size))]
+                if not days:
+                    break
+                keys = [(row[0], row[1]) for row in tx.execute(select([self.menus.c.canteen, self.menus.c.day])
+                                                               .where(self.menus.c.day.in_(days)))]
+                tx.execute(self.meals.delete().where(self.meals.c.menu_day.in_(days)))
+                tx.execute(self.menus.delete().where(self.menus.c.day.in_(days)))
+            for key in keys:
+                self.cache.invalidate(key)
+            deleted += len(keys)
+        self.search_index.remove_before(before)
+        if deleted:
+            logging.getLogger("maubot").info(f"Pruned {deleted} menus before {before}.")
+        return deleted
+
+    def get_job_run(self, name: str) -> Optional[datetime.datetime]:
+        """Return the time of the last successful run of a scheduled job (timezone-aware), or None."""
+        last_run = self.db.execute(select([self.jobs.c.last_run]).where(self.jobs.c.name == name)).scalar()
+        return pytz.utc.localize(last_run) if last_run is not None else None
+
+    def set_job_run(self, name: str, last_run: datetime.datetime) -> None:
+        """Store the time of the last successful run of a scheduled job, given timezone-aware."""
+        with self.db.begin() as tx:
+            if tx.execute(self.jobs.update().where(self.jobs.c.name == name)
+                          .values(last_run=_utc(last_run))).rowcount == 0:
+                tx.execute(self.jobs.insert().values(name=name, last_run=_utc(last_run)))
+
+    def search_meals(self, term: str, canteen: str) -> SearchResult:
+        """Return the days a canteen served meals whose name contains the term.
+        The search index is built with a single read of all meal names on the first search.
+        """
+        self.search_index.load(lambda: self.db.execute(
+            select([self.meals.c.canteen, self.meals.c.menu_day, self.meals.c.name]).distinct()))
+        return self.search_index.search(term, canteen)
+
+    def replace_movies(self, movies: List[Tuple[datetime.datetime, str]]) -> None:
+        with self.db.begin() as tx:
+            tx.execute(self.movies.delete())
+            if movies:
+                tx.execute(self.movies.insert(), [{"start": start, "title": title} for start, title in movies])
+
+    def get_movies(self) -> List[Tuple[datetime.datetime, str]]:
+        rows = self.db.execute(select([self.movies]).order_by(self.movies.c.start))
+        return [(row[0], row[1]) for row in rows]
+
+
+def _utc(moment: datetime.datetime) -> datetime.datetime:
+    return moment.astimezone(pytz.utc).replace(tzinfo=None)
+
+
+def diff_meals(canteen: str, day: datetime.date, stored: Counter, incoming: Counter) -> MenuChanges:
+    """Compare stored and incoming meals, both given as counts of (name, price).
+    A meal whose name is both removed and added is reported as price change.
+    """
+    removed = list((stored - incoming).elements())
+    added = list((incoming - stored).elements())
+    changes = MenuChanges(canteen=canteen, day=day)
+    for name, price in removed:
+        match = next((meal for meal in added if meal[0] == name), None)
+        if match is None:
+            changes.removed.append(Meal(menu_day=day, name=name, price=price))
+        else:
+            added.remove(match)
+            changes.price_changed.append((Meal(menu_day=day, name=name, price=price),
+                                          Meal(menu_day=day, name=match[0], price=match[1])))
+    changes.added = [Meal(menu_day=day, name=name, price=price) for name, price in added]
+    return changes
+
+
+class AsyncMenuDatabase:
+    """Awaitable facade of MenuDatabase for the plugin's command handlers.
+    Queries run on a dedicated, bounded thread pool so that a slow database never blocks the event loop.
+    Results are materialized to lists inside the worker thread.
+    """
+    menu_db: MenuDatabase
+    executor: ThreadPoolExecutor
+    loop: asyncio.AbstractEventLoop
+
+    def __init__(self, menu_db: MenuDatabase, executor: ThreadPoolExecutor,
+                 loop: asyncio.AbstractEventLoop = None) -> None:
+        self.menu_db = menu_db
+        self.executor = executor
+        self.loop = loop or asyncio.get_event_loop()
+
+    @classmethod
+    async def create(cls, db: Engine, max_workers: int = 4, loop: asyncio.AbstractEventLoop = None,
+                     **kwargs) -> "AsyncMenuDatabase":
+        """Create or migrate the tables on the thread pool and return the facade.
+
+        @param db: SQLAlchemy engine
+        @param max_workers: Maximum number of queries running at the same time
+        @param loop: Event loop of the plugin
+        @return: AsyncMenuDatabase
+        """
+        loop = loop or asyncio.get_event_loop()
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mensabot-db")
+        menu_db = await loop.run_in_executor(executor, partial(MenuDatabase, db, **kwargs))
+        return cls(menu_db, executor, loop)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
+
+    @property
+    def cache(self) -> MenuCache:
+        return self.menu_db.cache
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """Run a blocking function on the database thread pool."""
+        with DB_QUERY_SECONDS.time(method=func.__name__):
+            return await self.loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def run_list(self, func: Callable, *args, **kwargs) -> List:
+        """Run a blocking function returning an iterator on the database thread pool and collect its results."""
+        with DB_QUERY_SECONDS.time(method=func.__name__):
+            return await self.loop.run_in_executor(self.executor, lambda: list(func(*args, **kwargs)))
+
+    async def upsert_menu(self, menu: Menu) -> MenuChanges:
+        return await self.run(self.menu_db.upsert_menu, menu)
+
+    async def upsert_menus(self, menus: List[Menu]) -> List[MenuChanges]:
+        return await self.run(self.menu_db.upsert_menus, menus)
+
+    async def get_menu_on_day(self, canteen: str, day: datetime.date) -> List[Menu]:
+        # cache hits are answered without a round-trip to the thread pool
+        menus = self.menu_db.cache.get((canteen, day))
+        if menus is not None:
+            return menus
+        logging.getLogger("maubot").info(f"Search for day {day} in {canteen}")
+        return await self.run(self.menu_db.load_menu_on_day, canteen, day)
+
+    async def get_menus_between(self, canteens: Union[str, List[str]], first_day: datetime.date,
+                                last_day: datetime.date) -> List[Menu]:
+        return await self.run_list(self.menu_db.get_menus_between, canteens, first_day, last_day)
+
+    async def warm_cache(self, canteens: List[str], first_day: datetime.date, last_day: datetime.date) -> None:
+        await self.run(self.menu_db.warm_cache, canteens, first_day, last_day)
+
+    async def warm_start(self, canteens: List[str], first_day: datetime.date,
+                         last_day: datetime.date) -> List[Tuple[str, str]]:
+        return await self.run(self.menu_db.warm_start, canteens, first_day, last_day)
+
+    async def insert_subscription(self, room_id: str, canteen: str) -> None:
+        await self.run(self.menu_db.insert_subscription, room_id, canteen)
+
+    async def update_subscription(self, room_id: str, canteen: str) -> None:
+        await self.run(self.menu_db.update_subscription, room_id, canteen)
+
+    async def insert_subscriptions(self, subscriptions: List[Tuple[str, str]]) -> None:
+        if subscriptions:
+            await self.run(self.menu_db.insert_subscriptions, subscriptions)
+
+    async def update_subscriptions(self, subscriptions: List[Tuple[str, str]]) -> None:
+        if subscriptions:
+            await self.run(self.menu_db.update_subscriptions, subscriptions)
+
+    async def get_all_subscriptions(self) -> List[Tuple[str, str]]:
+        return await self.run(self.menu_db.get_all_subscriptions)
+
+    async def delete_subscription(self, room_id: str) -> None:
+        await self.run(self.menu_db.delete_subscription, room_id)
+
+    async def delete_subscriptions(self, room_ids: List[str]) -> None:
+        if room_ids:
+            await self.run(self.menu_db.delete_subscriptions, room_ids)
+
+    async def get_first_menu_day(self, canteen: str, from_day: datetime.date) -> Optional[datetime.date]:
+        return await self.run(self.menu_db.get_first_menu_day, canteen, from_day)
+
+    async def prune_menus(self, before: datetime.date, batch_size: int = 500) -> int:
+        return await self.run(self.menu_db.prune_menus, before, batch_size)
+
+    async def get_job_run(self, name: str) -> Optional[datetime.datetime]:
+        return await self.run(self.menu_db.get_job_run, name)
+
+    async def set_job_run(self, name: str, last_run: datetime.datetime) -> None:
+        await self.run(self.menu_db.set_job_run, name, last_run)
+
+    async def search_meals(self, term: str, canteen: str) -> SearchResult:
+        # once the index is built, searches are answered without a round-trip to the thread pool
+        if self.menu_db.search_index.loaded:
+            return self.menu_db.search_index.search(term, canteen)
+        return await self.run(self.menu_db.search_meals, term, canteen)
+
+    async def replace_movies(self, movies: List[Tuple[datetime.datetime, str]]) -> None:
+        await self.run(self.menu_db.replace_movies, movies)
+
+    async def get_movies(self) -> List[Tuple[datetime.datetime, str]]:
+        return await self.run(self.menu_db.get_movies)
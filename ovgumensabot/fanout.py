@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List
+
+import aiohttp
+from attr import dataclass, Factory
+from mautrix.errors import MatrixConnectionError, MatrixRequestError, MForbidden, MLimitExceeded, MNotFound
+
+# errors after which sending to a room again will not succeed
+PERMANENT_ERRORS = (MForbidden, MNotFound)
+# errors without an HTTP status after which sending again may succeed
+NETWORK_ERRORS = (MatrixConnectionError, aiohttp.ClientError, asyncio.TimeoutError)
+
+
+def is_transient(error: Exception) -> bool:
+    """Return True if sending again may succeed: on rate limits, server errors (5xx) and network errors.
+    Other client errors like M_TOO_LARGE or M_UNKNOWN_TOKEN fail the same way on every attempt.
+    """
+    if isinstance(error, MatrixRequestError):
+        return isinstance(error, MLimitExceeded) or (error.http_status or 0) >= 500
+    return isinstance(error, NETWORK_ERRORS)
+
+
+@dataclass
+class FanOutReport:
+    """This class represents the outcome of one fan-out run"""
+    delivered: int = 0
+    failed: int = 0
+    retried: int = 0
+    # number of attempts per room
+    attempts: Dict[str, int] = Factory(dict)
+    # rooms that failed with a permanent error (see PERMANENT_ERRORS)
+    unreachable: List[str] = Factory(list)
+
+    def __str__(self) -> str:
+        return (f"delivered {self.delivered}, failed {self.failed} ({len(self.unreachable)} unreachable), "
+                f"retried {self.retried}")
+
+
+async def fan_out(room_ids: Iterable[str], send: Callable[[str], Awaitable], concurrency: int = 8,
+                  max_retries: int = 5, base_delay: float = 1.0) -> FanOutReport:
+    """Call send for every room with bounded concurrency.
+    M_LIMIT_EXCEEDED pauses all senders for an exponential backoff with jitter, network and server errors are retried
+    per room with the same backoff (see is_transient()). Other errors, of any type, fail the room right away.
+    mautrix does not pass on the retry_after_ms of a rate limit response, so the backoff cannot follow it.
+
+    @param room_ids: Room IDs to send to
+    @param send: Coroutine function sending to a single room
+    @param concurrency: Maximum number of sends in flight
+    @param max_retries: Maximum number of retries per room
+    @param base_delay: Initial backoff in seconds, doubled on every retry
+    @return: FanOutReport
+    """
+    log = logging.getLogger("maubot")
+    semaphore = asyncio.Semaphore(concurrency)
+    report = FanOutReport()
+    # the homeserver rate-limits the bot user, not a single room, so a limit pauses every sender
+    resume_at = 0.0
+
+    async def deliver(room_id: str) -> None:
+        nonlocal resume_at
+        attempt = 0
+        while True:
+            attempt += 1
+            report.attempts[room_id] = attempt
+            async with semaphore:
+                pause = resume_at - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                try:
+                    await send(room_id)
+                    report.delivered += 1
+                    return
+                except PERMANENT_ERRORS as e:
+                    log.error(f"Room {room_id} is unreachable: {e}")
+                    report.failed += 1
+                    report.unreachable.append(room_id)
+                    return
+                except (MatrixRequestError, *NETWORK_ERRORS) as e:
+                    if not is_transient(e):
+                        log.error(f"Failed to send to room {room_id}: {e!r}")
+                        report.failed += 1
+                        return
+                    if attempt > max_retries:
+                        log.error(f"Giving up on room {room_id} after {attempt} attempts: {e!r}")
+                        report.failed += 1
+                        return
+                    delay = base_delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                    if isinstance(e, MLimitExceeded):
+                        resume_at = max(resume_at, time.monotonic() + delay)
+                    log.warning(f"Retrying room {room_id} in {delay:.1f} seconds: {e!r}")
+                    report.retried += 1
+                except Exception as e:
+                    # e.g. MatrixResponseError or encryption errors, which must not abort the other rooms
+                    log.exception(f"Failed to send to room {room_id}: {e!r}")
+                    report.failed += 1
+                    return
+            # wait outside of the semaphore so other rooms can be served meanwhile
+            await asyncio.sleep(delay)
+
+    await asyncio.gather(*(deliver(room_id) for room_id in room_ids))
+    return report
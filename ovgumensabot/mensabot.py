@@ -1,31 +1,83 @@
 import asyncio
+import re
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from html import escape
 from datetime import datetime, timedelta, date
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple, Type
 
 import pytz
-from markdown import markdown
+from aiohttp.web import Request, Response
 from maubot import Plugin, MessageEvent
-from maubot.handlers import command
+from maubot.handlers import command, web
 from mautrix.errors import MForbidden
 from mautrix.types import TextMessageEventContent, MessageType, Format, RelatesTo, RelationType, RoomID
+from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 
-from .db import MenuDatabase
-from .menu import Menu
-from .parser import get_menus, parse_movies
-
-URLS = [
-    'https://www.studentenwerk-magdeburg.de/mensen-cafeterien/mensa-unicampus-speiseplan-unten/',
-    'https://www.studentenwerk-magdeburg.de/mensen-cafeterien/mensa-unicampus-speiseplan-oben/'
-    # 'https://www.studentenwerk-magdeburg.de/mensen-cafeterien/mensa-stendal/speiseplan/',
-    # 'https://www.studentenwerk-magdeburg.de/mensen-cafeterien/mensa-herrenkrug/speiseplan/',
-    # 'https://www.studentenwerk-magdeburg.de/mensen-cafeterien/mensa-kellercafe/speiseplan/'
-]
-NOTIF_TIME = {
-    "h": 14,
-    "m": 30
+from .db import AsyncMenuDatabase
+from . import metrics
+from .fanout import fan_out
+from .metrics import COMMAND_SECONDS, SEND_FAILURES, SEND_SECONDS
+from .menu import Menu, MenuChanges, merge_menus
+from .scheduler import Schedule, ScheduledJob, parse_schedule
+from .scraper import ScraperClient
+from .render import MenuRenderer, render_menus
+from .search import SearchResult
+from .subscriptions import SubscriptionRegistry
+
+if TYPE_CHECKING:
+    # the parser pulls in BeautifulSoup, it is imported on the first fetch instead of on start
+    from .parser import PageState
+
+# speiseplan pages per canteen, the meals of all pages of a canteen are merged per day
+CANTEENS = {
+    "unicampus": [
+        'https://www.studentenwerk-magdeburg.de/mensen-cafeterien/mensa-unicampus-speiseplan-unten/',
+        'https://www.studentenwerk-magdeburg.de/mensen-cafeterien/mensa-unicampus-speiseplan-oben/'
+    ],
+    "stendal": ['https://www.studentenwerk-magdeburg.de/mensen-cafeterien/mensa-stendal/speiseplan/'],
+    "herrenkrug": ['https://www.studentenwerk-magdeburg.de/mensen-cafeterien/mensa-herrenkrug/speiseplan/'],
+    "kellercafe": ['https://www.studentenwerk-magdeburg.de/mensen-cafeterien/mensa-kellercafe/speiseplan/']
 }
+# canteen used if the configured canteens are all unknown
+DEFAULT_CANTEEN = "unicampus"
+# maximum number of canteen pages downloaded at the same time
+FETCH_CONCURRENCY = 4
+# timeouts of a single page download attempt in seconds: connecting, between two reads and in total
+FETCH_CONNECT_TIMEOUT = 10
+FETCH_READ_TIMEOUT = 20
+FETCH_TIMEOUT = 30
+# maximum number of retries of a page download, with jittered exponential backoff starting at one second
+FETCH_MAX_RETRIES = 3
+# failed downloads in a row after which a host is not requested for CIRCUIT_RESET_TIMEOUT seconds
+CIRCUIT_FAILURE_THRESHOLD = 3
+CIRCUIT_RESET_TIMEOUT = 600
+# number of days starting today that are loaded into the menu cache after fetching
+CACHE_WARM_DAYS = 14
+# maximum number of database queries running at the same time, each on its own worker thread
+DB_WORKERS = 4
+# maximum number of rooms notified at the same time
+NOTIFY_CONCURRENCY = 8
+# maximum number of retries per room on rate limits, server errors and network errors
+NOTIFY_MAX_RETRIES = 5
+# remove subscriptions of rooms the bot can no longer send to (forbidden or unknown room)
+DROP_UNREACHABLE_SUBSCRIPTIONS = True
+# time at which menus older than retention_days are deleted
+PRUNE_TIME = "03:00"
+# maximum age of a missed notification that is sent when the plugin starts again
+NOTIFY_CATCH_UP = timedelta(hours=6)
+# maximum number of days shown by "!hunger week" and "!hunger dd.mm.yyyy-dd.mm.yyyy"
+MAX_RANGE_DAYS = 14
+HID_URL = "https://www.unifilm.de/studentenkinos/MD_HiD"
 TZ = pytz.timezone('Europe/Berlin')
 
 
+def markdown(text: str) -> str:
+    """Render markdown to HTML, importing the markdown package on first use to keep the plugin start fast."""
+    from markdown import markdown as render
+    return render(text)
+
+
 def date_keyword_to_date(date_keyword) -> date:
     switcher = {
         "today": date.today(),
@@ -47,50 +99,194 @@ def formatted_movie_list(movies: list[tuple[datetime, str]]) -> str:
     return ret
 
 
+def week_range(today: date, weeks: int = 0) -> Tuple[date, date]:
+    """Return Monday and Friday of the current week, or of the next week on weekends."""
+    monday = today - timedelta(days=today.weekday()) + timedelta(weeks=weeks + (today.weekday() >= 5))
+    return monday, monday + timedelta(days=4)
+
+
+def parse_day_range(message: str) -> Optional[Tuple[date, date]]:
+    """Return the first and last day of "week", "next week" or "dd.mm.yyyy-dd.mm.yyyy", or None."""
+    if message == "week":
+        return week_range(date.today())
+    if message == "next week":
+        return week_range(date.today(), weeks=1)
+    match = re.fullmatch(r"(\d{2}\.\d{2}\.\d{4})\s*-\s*(\d{2}\.\d{2}\.\d{4})", message)
+    if match is None:
+        return None
+    return (datetime.strptime(match.group(1), "%d.%m.%Y").date(),
+            datetime.strptime(match.group(2), "%d.%m.%Y").date())
+
+
+def semester_start(day: date) -> date:
+    """Return the first day of the semester of a day, semesters start on April 1 and October 1."""
+    if day.month >= 10:
+        return date(day.year, 10, 1)
+    if day.month >= 4:
+        return date(day.year, 4, 1)
+    return date(day.year - 1, 10, 1)
+
+
+def formatted_search_result(result: SearchResult, today: date) -> str:
+    ret = f"Search for **{result.term}** in {result.canteen}:\n\n"
+    next_day = result.next_day(today)
+    if next_day is None:
+        ret += "* Not on the current menus\n"
+    else:
+        ret += f"* Next on {next_day.strftime('%A, %d.%m.%Y')}: {', '.join(result.meals[next_day])}\n"
+    last_day = result.last_day(today)
+    if last_day is not None:
+        ret += f"* Last on {last_day.strftime('%A, %d.%m.%Y')}: {', '.join(result.meals[last_day])}\n"
+    first_day = semester_start(today)
+    ret += (f"* {result.count_between(first_day, today)} days this semester (since {first_day.strftime('%d.%m.%Y')}), "
+            f"{len(result.days)} days in total\n")
+    return ret
+
+
+class Config(BaseProxyConfig):
+    def do_update(self, helper: ConfigUpdateHelper) -> None:
+        helper.copy("canteens")
+        helper.copy("min_fetch_interval")
+        helper.copy("movie_cache_ttl")
+        helper.copy("admins")
+        helper.copy("parser_pool")
+        helper.copy("parser_workers")
+        helper.copy("retention_days")
+        helper.copy("retention_batch_size")
+        helper.copy("fetch_schedule")
+        helper.copy("notification_schedule")
+        helper.copy("schedule_jitter")
+        helper.copy("schedule_retry_delay")
+        helper.copy("schedule_max_retries")
+
+
 class MensaBot(Plugin):
-    db: MenuDatabase
-    loop_task: asyncio.Future
+    db: AsyncMenuDatabase
+    subscriptions: SubscriptionRegistry
+    # enabled canteens, the first one is the default of rooms without subscription
+    canteens: List[str]
+    jobs: List[ScheduledJob]
+    notification_schedule: Schedule
+    page_states: Dict[str, "PageState"]
+    pages_fetched: int
+    pages_skipped: int
+    fetch_task: Optional[asyncio.Future]
+    # canteens that failed or kept menus of an earlier fetch in the last fetch
+    failed_canteens: List[str]
+    last_fetch: float
+    movies: Optional[List[Tuple[datetime, str]]]
+    movies_updated: float
+    movies_task: Optional[asyncio.Future]
+    parser_executor: Executor
+    scraper: ScraperClient
+    renderer: MenuRenderer
+    # meals of the menu version last pushed to subscribers, per canteen and day
+    notified_versions: Dict[Tuple[str, date], Tuple[Tuple[str, str], ...]]
+
+    @classmethod
+    def get_config_class(cls) -> Type[BaseProxyConfig]:
+        return Config
 
     async def start(self) -> None:
-        self.db = MenuDatabase(self.database)
-        self.loop_task = asyncio.ensure_future(self.fetch_loop(), loop=self.loop)
+        self.config.load_and_update()
+        if self.config["parser_pool"] == "process":
+            self.parser_executor = ProcessPoolExecutor(max_workers=self.config["parser_workers"])
+        else:
+            self.parser_executor = ThreadPoolExecutor(max_workers=self.config["parser_workers"],
+                                                      thread_name_prefix="mensabot-parser")
+        # requests go through the plugin's session to reuse its connections
+        self.scraper = ScraperClient(self.http, connect_timeout=FETCH_CONNECT_TIMEOUT,
+                                     read_timeout=FETCH_READ_TIMEOUT, total_timeout=FETCH_TIMEOUT,
+                                     max_retries=FETCH_MAX_RETRIES, failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                                     reset_timeout=CIRCUIT_RESET_TIMEOUT)
+        self.db = await AsyncMenuDatabase.create(self.database, max_workers=DB_WORKERS, loop=self.loop)
+        self.canteens = [canteen for canteen in self.config["canteens"] if canteen in CANTEENS]
+        for canteen in set(self.config["canteens"]) - set(CANTEENS):
+            self.log.warning(f"Ignoring unknown canteen {canteen}")
+        if not self.canteens:
+            self.canteens = [DEFAULT_CANTEEN]
+        # upcoming menus and all subscriptions are loaded on one connection, so the first commands need no query
+        subscriptions = await self.db.warm_start(self.canteens, date.today(),
+                                                 date.today() + timedelta(days=CACHE_WARM_DAYS - 1))
+        self.subscriptions = SubscriptionRegistry(self.db)
+        await self.subscriptions.load(subscriptions)
+        self.page_states = {}
+        self.pages_fetched = 0
+        self.pages_skipped = 0
+        self.fetch_task = None
+        self.failed_canteens = []
+        self.last_fetch = float("-inf")
+        self.movies = None
+        self.movies_updated = float("-inf")
+        self.movies_task = None
+        self.notified_versions = {}
+        self.renderer = MenuRenderer()
+        retry = dict(retry_delay=self.config["schedule_retry_delay"], max_retries=self.config["schedule_max_retries"])
+        self.notification_schedule = Schedule(parse_schedule(self.config["notification_schedule"]), TZ)
+        self.jobs = [
+            ScheduledJob("fetch", Schedule(parse_schedule(self.config["fetch_schedule"]), TZ), self.scheduled_fetch,
+                         self.db, jitter=self.config["schedule_jitter"], **retry),
+            # notifications are not delayed by jitter, they are announced for a fixed time
+            ScheduledJob("notify", self.notification_schedule, self.autofetch_menus, self.db,
+                         catch_up=NOTIFY_CATCH_UP, **retry),
+            ScheduledJob("prune", Schedule(parse_schedule([PRUNE_TIME]), TZ), self.prune_menus, self.db,
+                         jitter=self.config["schedule_jitter"], **retry)
+        ]
+        for job in self.jobs:
+            job.start()
 
     async def stop(self) -> None:
-        self.loop_task.cancel()
-
-    async def fetch_loop(self) -> None:
-        try:
-            self.log.debug("Fetching loop started")
-            while True:
-                now = datetime.now(TZ)
-                days = 1 if now > now.replace(hour=NOTIF_TIME.get("h"), minute=NOTIF_TIME.get("m"), second=0,
-                                              microsecond=0) else 0
-                scheduled_time = now.replace(hour=NOTIF_TIME.get("h"), minute=NOTIF_TIME.get("m"), second=0,
-                                             microsecond=0) + timedelta(days=days)
-                self.log.info(f"Scheduled fetch for {scheduled_time} in {scheduled_time - now} seconds")
-                await asyncio.sleep((scheduled_time - now).total_seconds())
-                asyncio.create_task(self.autofetch_menus())
-        except asyncio.CancelledError:
-            self.log.debug("Fetching loop stopped")
-        except Exception:
-            self.log.exception("Exception in fetching loop")
+        for job in self.jobs:
+            job.stop()
+        self.db.close()
+        self.parser_executor.shutdown(wait=False)
+        await self.scraper.close()
 
     @command.new("hunger", help="Show the meals")
     @command.argument("message", pass_raw=True, required=False)
+    @COMMAND_SECONDS.timed(command="hunger")
     async def hunger_handler(self, evt: MessageEvent, message: str = "") -> None:
-        new_menu = False
+        words = message.split()
+        canteen_word = next((word for word in words if word.lower() in self.canteens), None)
+        if canteen_word is None:
+            canteen = self.get_room_canteen(evt.room_id)
+        else:
+            canteen = canteen_word.lower()
+            words.remove(canteen_word)
+            message = " ".join(words)
+        if message.split(" ", 1)[0] == "search":
+            term = message[len("search"):].strip()
+            if not term:
+                await evt.respond("Usage: `!hunger [canteen] search <meal>`")
+                return
+            result = await self.db.search_meals(term, canteen)
+            await evt.respond(formatted_search_result(result, date.today()))
+            return
+        changed = set()
         if "fetch" in message:
-            new_menu = await self.fetch_menus()
+            wait = self.seconds_until_next_fetch()
+            if wait > 0 and (self.fetch_task is None or self.fetch_task.done()):
+                await evt.respond(f"The menus were fetched less than {self.config['min_fetch_interval']} seconds "
+                                  f"ago, showing the stored menus. Try again in {wait:.0f} seconds.")
+            else:
+                changed = {(changes.canteen, changes.day) for changes in await self.fetch_menus()}
             message = message.replace('fetch', '').strip()
+        try:
+            day_range = parse_day_range(message)
+        except ValueError:
+            day_range = None
+        if day_range is not None:
+            await self.post_menu_range(evt, canteen, *day_range, changed=changed)
+            return
         date_keywords = ["today", "tomorrow", "monday", "tuesday", "wednesday", "thursday", "friday"]
         if any(x in message.strip() for x in date_keywords):
-            menus = self.db.get_menu_on_day(date_keyword_to_date(message))
+            menus = await self.db.get_menu_on_day(canteen, date_keyword_to_date(message))
         elif message == "":
-            menus = self.db.get_menu_on_day(self.get_next_available_day())
+            menus = await self.db.get_menu_on_day(canteen, await self.get_next_available_day(canteen))
         else:
             try:
                 parsed_date: datetime.date = datetime.strptime(message.strip(), "%d.%m.%Y").date()
-                menus = self.db.get_menu_on_day(parsed_date)
+                menus = await self.db.get_menu_on_day(canteen, parsed_date)
             except Exception:
                 content = TextMessageEventContent(
                     msgtype=MessageType.NOTICE, format=Format.HTML,
@@ -99,7 +295,8 @@ class MensaBot(Plugin):
                                             f"<br>Expected format: `dd.mm.yyyy`"
                                             f"<br>"
                                             f"<br>You can also use keywords like `today`, `tomorrow`, `monday`,"
-                                            f"`tuesday`, etc."),
+                                            f"`tuesday`, etc."
+                                            f"<br>Canteens: {', '.join(f'`{name}`' for name in self.canteens)}"),
                     relates_to=RelatesTo(
                         rel_type=RelationType("com.valentinriess.mensa"),
                         event_id=evt.event_id,
@@ -110,27 +307,43 @@ class MensaBot(Plugin):
         run = False
         for menu in menus:
             run = True
-            if new_menu:
-                await self.notify_subscribers(menu=menu)
-                # do not send message twice if a subscriber triggered hunger and there is a new menu
-                if not self.db.subscription_exists(room_id=evt.room_id):
+            if (menu.canteen, menu.day) in changed:
+                notified = await self.notify_subscribers(menu=menu)
+                # do not send message twice if a subscriber triggered hunger and there is a changed menu
+                if not notified or self.subscriptions.get(evt.room_id) != menu.canteen:
                     await self.post_menu(room_id=evt.room_id, menu=menu)
             else:
                 await self.post_menu(room_id=evt.room_id, menu=menu)
         if not run:
             content = TextMessageEventContent(
                 msgtype=MessageType.NOTICE, format=Format.HTML,
-                body=f"No meal for {message} :/",
-                formatted_body=markdown(f"No meal for **{message}** :/"),
+                body=f"No meal for {message} in {canteen} :/",
+                formatted_body=markdown(f"No meal for **{message}** in **{canteen}** :/"),
                 relates_to=RelatesTo(
                     rel_type=RelationType("com.valentinriess.mensa"),
                     event_id=evt.event_id,
                 ))
             await evt.respond(content)
 
-    @command.new("subscribe", help="Get notified every day with the menu")
-    async def subscribe(self, evt: MessageEvent) -> None:
-        if self.db.subscription_exists(evt.room_id):
+    @command.new("subscribe", help="Get notified every day with the menu of a canteen")
+    @command.argument("canteen", required=False)
+    @COMMAND_SECONDS.timed(command="subscribe")
+    async def subscribe(self, evt: MessageEvent, canteen: str = "") -> None:
+        canteen = canteen.strip().lower() or self.canteens[0]
+        if canteen not in self.canteens:
+            content = TextMessageEventContent(
+                msgtype=MessageType.NOTICE, format=Format.HTML,
+                body=f"Unknown canteen {canteen}. Canteens: {', '.join(self.canteens)}",
+                formatted_body=markdown(f"Unknown canteen **{canteen}**."
+                                        f"<br>Canteens: {', '.join(f'`{name}`' for name in self.canteens)}"),
+                relates_to=RelatesTo(
+                    rel_type=RelationType("com.valentinriess.mensa"),
+                    event_id=evt.event_id,
+                ))
+            await evt.respond(content)
+            return
+        subscribed_canteen = self.subscriptions.get(evt.room_id)
+        if subscribed_canteen == canteen:
             content = TextMessageEventContent(
                 msgtype=MessageType.NOTICE, format=Format.HTML,
                 body="Your subscription is already active. Nothing to do here.",
@@ -140,15 +353,27 @@ class MensaBot(Plugin):
                     event_id=evt.event_id,
                 ))
             await evt.respond(content)
+        elif subscribed_canteen is not None:
+            await self.subscriptions.add(evt.room_id, canteen)
+            content = TextMessageEventContent(
+                msgtype=MessageType.NOTICE, format=Format.HTML,
+                body=f"Your subscription now notifies you about {canteen} instead of {subscribed_canteen}.",
+                formatted_body=markdown(f"Your subscription now notifies you about **{canteen}** "
+                                        f"instead of {subscribed_canteen}."),
+                relates_to=RelatesTo(
+                    rel_type=RelationType("com.valentinriess.mensa"),
+                    event_id=evt.event_id,
+                ))
+            await evt.respond(content)
         else:
-            self.db.insert_subscription(evt.room_id)
+            await self.subscriptions.add(evt.room_id, canteen)
             content = TextMessageEventContent(
                 msgtype=MessageType.NOTICE, format=Format.HTML,
                 body=f"Enjoy your meal! Use !unsubscribe to end your subscription. Notifications can be expected "
-                     f"every day at {NOTIF_TIME.get('h')}:{NOTIF_TIME.get('m')}.",
+                     f"every day at {self.notification_schedule.describe()}.",
                 formatted_body=markdown("Enjoy your meal! Use `!unsubscribe` to end your subscription."
                                         "<br><br>Notifications can be expected "
-                                        f"every day at **{NOTIF_TIME.get('h')}:{NOTIF_TIME.get('m')}**."
+                                        f"every day at **{self.notification_schedule.describe()}**."
                                         ),
                 relates_to=RelatesTo(
                     rel_type=RelationType("com.valentinriess.mensa"),
@@ -157,8 +382,9 @@ class MensaBot(Plugin):
             await evt.respond(content)
 
     @command.new("unsubscribe", help="End your daily subscription.")
+    @COMMAND_SECONDS.timed(command="unsubscribe")
     async def unsubscribe(self, evt: MessageEvent) -> None:
-        if not self.db.subscription_exists(evt.room_id):
+        if evt.room_id not in self.subscriptions:
             content = TextMessageEventContent(
                 msgtype=MessageType.NOTICE, format=Format.HTML,
                 body="You have no active subscription. Nothing to do here.",
@@ -169,7 +395,7 @@ class MensaBot(Plugin):
                 ))
             await evt.respond(content)
         else:
-            self.db.delete_subscription(evt.room_id)
+            await self.subscriptions.remove(evt.room_id)
             content = TextMessageEventContent(
                 msgtype=MessageType.NOTICE, format=Format.HTML,
                 body="Your subscription has been cancelled.",
@@ -181,8 +407,9 @@ class MensaBot(Plugin):
             await evt.respond(content)
 
     @command.new("hid", help="Next Hörsaal im Dunkeln event")
+    @COMMAND_SECONDS.timed(command="hid")
     async def hid(self, evt: MessageEvent) -> None:
-        movies = await parse_movies(self, "https://www.unifilm.de/studentenkinos/MD_HiD")
+        movies = list(await self.get_movies())
 
         # remove all old movies
         movies[:] = [movie for movie in movies if movie[0].date() >= datetime.now(TZ).date()]
@@ -199,51 +426,231 @@ class MensaBot(Plugin):
         self.log.info(f"Movies on next movie day: {movies}")
         await evt.respond(formatted_movie_list(movies))
 
-    async def fetch_menus(self) -> None:
-        days = []
-        for url in URLS:
-            menus = await get_menus(mensabot=self, url=url)
-            for menu in menus:
-                if menu.day in days:
-                    self.db.add_meals_to_menu(menu)
-                else:
-                    self.db.upsert_menu(menu)
-                    days.append(menu.day)
+    @command.new("mensastats", help="Show performance metrics (admins only)")
+    async def mensastats(self, evt: MessageEvent) -> None:
+        if evt.sender not in self.config["admins"]:
+            await evt.respond("This command is only available to admins.")
+            return
+        summary = metrics.summary() or "No metrics recorded yet."
+        content = TextMessageEventContent(
+            msgtype=MessageType.NOTICE, format=Format.HTML,
+            body=summary,
+            formatted_body=f"<pre><code>{escape(summary)}</code></pre>",
+            relates_to=RelatesTo(
+                rel_type=RelationType("com.valentinriess.mensa"),
+                event_id=evt.event_id,
+            ))
+        await evt.respond(content)
+
+    @web.get("/metrics")
+    async def metrics_endpoint(self, req: Request) -> Response:
+        return Response(text=metrics.expose(), content_type="text/plain")
+
+    async def get_movies(self) -> List[Tuple[datetime, str]]:
+        """Return the movie schedule from memory or the database.
+        An expired schedule is returned as is while a refresh runs in the background (stale-while-revalidate),
+        the movie page is only awaited if there is no schedule at all.
+        """
+        if self.movies is None:
+            # a schedule loaded from the database has an unknown age and is refreshed right away
+            self.movies = await self.db.get_movies() or None
+        if self.movies is None:
+            await self.refresh_movies()
+        elif time.monotonic() - self.movies_updated > self.config["movie_cache_ttl"]:
+            self.refresh_movies()
+        return self.movies or []
+
+    def refresh_movies(self) -> asyncio.Future:
+        if self.movies_task is None or self.movies_task.done():
+            self.movies_task = asyncio.ensure_future(self._refresh_movies(), loop=self.loop)
+        return self.movies_task
+
+    async def _refresh_movies(self) -> None:
+        from .parser import parse_movies
+        # runs in the background after the first refresh, so nobody awaits it and errors have to be logged here
+        try:
+            movies = await parse_movies(self, HID_URL, executor=self.parser_executor)
+            await self.db.replace_movies(movies)
+        except Exception:
+            self.log.exception("Failed to refresh movie schedule")
+            return
+        self.movies = movies
+        self.movies_updated = time.monotonic()
+        self.log.info(f"Refreshed movie schedule with {len(movies)} movies")
+
+    async def fetch_menus(self, force: bool = False) -> List[MenuChanges]:
+        """Fetch the menus of all enabled canteens.
+        Concurrent callers share one in-flight fetch, and pages are downloaded at most once per min_fetch_interval.
+
+        @param force: Download the pages even if the last successful fetch was less than min_fetch_interval ago
+        @return: Changes of all menus whose meals changed
+        """
+        if self.fetch_task is None or self.fetch_task.done():
+            # decided here rather than in the task, so that joining callers always share a fetch that downloads
+            if not force and self.seconds_until_next_fetch() > 0:
+                self.log.info(f"Skipping fetch, last fetch was {time.monotonic() - self.last_fetch:.0f} seconds ago")
+                return []
+            self.fetch_task = asyncio.ensure_future(self._fetch_menus(), loop=self.loop)
+        else:
+            self.log.info("Joining fetch already in progress")
+        # a cancelled caller must not cancel the fetch shared with the others
+        return await asyncio.shield(self.fetch_task)
+
+    def seconds_until_next_fetch(self) -> float:
+        """Return the time in seconds until min_fetch_interval has passed since the last successful fetch, or 0."""
+        return max(self.config["min_fetch_interval"] - (time.monotonic() - self.last_fetch), 0)
+
+    async def _fetch_menus(self) -> List[MenuChanges]:
+        from .parser import PageState, get_menus_conditional
+
+        semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+        async def fetch(url: str) -> bool:
+            async with semaphore:
+                state = self.page_states.setdefault(url, PageState())
+                return await get_menus_conditional(mensabot=self, url=url, state=state,
+                                                   executor=self.parser_executor)
+
+        async def fetch_canteen(canteen: str) -> List[MenuChanges]:
+            # nothing is written for a canteen unless every page of it could be loaded
+            changed = await asyncio.gather(*(fetch(url) for url in CANTEENS[canteen]))
+            skipped = changed.count(False)
+            self.pages_fetched += len(changed)
+            self.pages_skipped += skipped
+            if skipped == len(changed):
+                return []
+            # unchanged pages still contribute their cached menus, as meals of all pages are merged per day
+            menus = merge_menus(canteen, (self.page_states[url].menus for url in CANTEENS[canteen]))
+            return [changes for changes in await self.db.upsert_menus(menus) if changes.changed]
+
+        # all canteens are fetched at once, a failing canteen does not keep the others from being updated
+        results = await asyncio.gather(*(fetch_canteen(canteen) for canteen in self.canteens),
+                                       return_exceptions=True)
+        menu_changes = []
+        self.failed_canteens = []
+        for canteen, result in zip(self.canteens, results):
+            if isinstance(result, BaseException):
+                self.log.error(f"Failed to fetch menus of {canteen}", exc_info=result)
+                self.failed_canteens.append(canteen)
+            else:
+                menu_changes.extend(result)
+                stale = [url for url in CANTEENS[canteen] if self.page_states[url].failed]
+                if stale:
+                    # the previous menus of these pages were used, the scheduler has to retry all the same
+                    self.log.error(f"Using menus of an earlier fetch of {canteen} for {', '.join(stale)}")
+                    self.failed_canteens.append(canteen)
+        # only a fetch that downloaded pages counts, so a failed one can be repeated right away
+        if len(self.failed_canteens) < len(self.canteens):
+            self.last_fetch = time.monotonic()
+        self.log.info(f"{len(menu_changes)} menus changed, skip rate "
+                      f"{self.pages_skipped / max(self.pages_fetched, 1):.0%} of pages since start")
+        await self.db.warm_cache(self.canteens, date.today(), date.today() + timedelta(days=CACHE_WARM_DAYS - 1))
+        return menu_changes
+
+    async def scheduled_fetch(self) -> None:
+        """Fetch job of the scheduler. Fails if a canteen could not be fetched, so that the job is retried."""
+        await self.fetch_menus(force=True)
+        if self.failed_canteens:
+            raise RuntimeError(f"Failed to fetch menus of {', '.join(self.failed_canteens)}")
 
     async def autofetch_menus(self):
+        """Notification job of the scheduler. Sends the menus of tomorrow to the subscribers of each canteen."""
         self.log.info("Autofetching...")
-        if self.db.subscriptions_not_empty():
+        if self.subscriptions:
             await self.fetch_menus()
-            if self.get_next_available_day() == date.today() + timedelta(days=1):
-                for menu in self.db.get_menu_on_day(self.get_next_available_day()):
-                    await self.notify_subscribers(menu)
+            for canteen in self.canteens:
+                next_day = await self.get_next_available_day(canteen)
+                if next_day == date.today() + timedelta(days=1):
+                    for menu in await self.db.get_menu_on_day(canteen, next_day):
+                        await self.notify_subscribers(menu)
+
+    async def prune_menus(self) -> None:
+        """Prune job of the scheduler. Deletes menus older than retention_days, if configured."""
+        if self.config["retention_days"] > 0:
+            await self.db.prune_menus(date.today() - timedelta(days=self.config["retention_days"]),
+                                      batch_size=self.config["retention_batch_size"])
+
+    async def notify_subscribers(self, menu: Menu) -> bool:
+        """Send a menu to the rooms subscribed to its canteen, once per menu version.
+        A version is identified by its meals, meals that only moved are no new version.
 
-    async def notify_subscribers(self, menu: Menu):
-        if self.db.subscriptions_not_empty():
-            for room_id in self.db.get_subscriptions():
-                self.log.info(f"Send menu update to room_id {room_id}")
-                await self.post_menu(room_id=room_id, menu=menu)
+        @param menu: Menu to send
+        @return: True if the menu was sent to the subscribers, False if it was already sent or there are none
+        """
+        key = (menu.canteen, menu.day)
+        version = tuple(sorted((meal.name, meal.price) for meal in menu.meals))
+        if self.notified_versions.get(key) == version:
+            self.log.info(f"Menu of {menu.canteen} for {menu.day} was already sent to subscribers")
+            return False
+        # set before sending, so concurrent calls for the same version do not push twice
+        self.notified_versions = {(canteen, day): meals for (canteen, day), meals
+                                  in self.notified_versions.items() if day >= date.today()}
+        self.notified_versions[key] = version
+        room_ids = self.subscriptions.rooms(menu.canteen)
+        if not room_ids:
+            return False
+        self.log.info(f"Send menu update of {menu.canteen} to {len(room_ids)} rooms")
+        report = await fan_out(room_ids, lambda room_id: self.send_menu(room_id=room_id, menu=menu),
+                               concurrency=NOTIFY_CONCURRENCY, max_retries=NOTIFY_MAX_RETRIES)
+        self.log.info(f"Menu update of {menu.canteen} for {menu.day}: {report}")
+        if DROP_UNREACHABLE_SUBSCRIPTIONS and report.unreachable:
+            self.log.info(f"Drop subscriptions of unreachable room_ids {', '.join(report.unreachable)}")
+            await self.subscriptions.remove_many(report.unreachable)
+        return True
+
+    async def send_menu(self, room_id: str, menu: Menu) -> None:
+        content = self.renderer.render(menu)
+        try:
+            with SEND_SECONDS.time():
+                await self.client.send_message(RoomID(room_id), content)
+        except Exception as e:
+            SEND_FAILURES.inc(error=type(e).__name__)
+            raise
 
     async def post_menu(self, room_id: str, menu: Menu) -> bool:
-        content = TextMessageEventContent(
-            msgtype=MessageType.NOTICE, format=Format.HTML,
-            body=f"{menu}",
-            formatted_body=f"{menu.to_html()}")
-        content["menu"] = menu.to_dict()
         try:
-            await self.client.send_message(RoomID(room_id), content)
+            await self.send_menu(room_id=room_id, menu=menu)
         except MForbidden:
             self.log.error("Wrong Room ID")
             return False
         return True
 
-    def get_next_available_day(self):
-        today = date.today()
-        today2pm = datetime.now(TZ).replace(hour=14, minute=0, second=0, microsecond=0)
-        days = self.db.get_menu_days()
-        for day in days:
-            if day >= today:
-                if day != today:  # no menu today, returning the next available
-                    return day
-                elif datetime.now(TZ) > today2pm:
-                    return days.__next__()
+    async def post_menu_range(self, evt: MessageEvent, canteen: str, first_day: date, last_day: date,
+                              changed: Set[Tuple[str, date]] = frozenset()) -> None:
+        """Respond with the menus of a canteen from first_day to last_day (inclusive) in a single message.
+        All days are loaded with one batched read.
+        """
+        if not 0 <= (last_day - first_day).days < MAX_RANGE_DAYS:
+            await evt.respond(f"Please ask for 1 to {MAX_RANGE_DAYS} days, starting with the first day.")
+            return
+        menus = await self.db.get_menus_between(canteen, first_day, last_day)
+        for menu in menus:
+            if (menu.canteen, menu.day) in changed:
+                await self.notify_subscribers(menu=menu)
+        if not menus:
+            content = TextMessageEventContent(
+                msgtype=MessageType.NOTICE, format=Format.HTML,
+                body=f"No meals from {first_day.strftime('%d.%m.%Y')} to {last_day.strftime('%d.%m.%Y')} "
+                     f"in {canteen} :/",
+                formatted_body=markdown(f"No meals from **{first_day.strftime('%d.%m.%Y')}** to "
+                                        f"**{last_day.strftime('%d.%m.%Y')}** in **{canteen}** :/"))
+        else:
+            content = render_menus(menus, first_day, last_day)
+        content.relates_to = RelatesTo(
+            rel_type=RelationType("com.valentinriess.mensa"),
+            event_id=evt.event_id,
+        )
+        await evt.respond(content)
+
+    def get_room_canteen(self, room_id: str) -> str:
+        """Return the canteen a room is subscribed to, or the default canteen."""
+        canteen = self.subscriptions.get(room_id)
+        return canteen if canteen in self.canteens else self.canteens[0]
+
+    async def get_next_available_day(self, canteen: str) -> Optional[date]:
+        """Return the first day with a menu of a canteen starting today, or starting tomorrow after 14:00."""
+        now = datetime.now(TZ)
+        first_day = now.date()
+        if now > now.replace(hour=14, minute=0, second=0, microsecond=0):
+            first_day += timedelta(days=1)
+        return await self.db.get_first_menu_day(canteen, first_day)
@@ -1,33 +1,32 @@
-import logging
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Iterable, Tuple
 
-import pytz
-from attr import dataclass
-from bs4 import BeautifulSoup
-from maubot import Plugin
+from attr import dataclass, Factory
 
 from .meal import Meal
 
 
 @dataclass
 class Menu:
-    """This class represents a menu (a list of meals)"""
+    """This class represents a menu (a list of meals) of a canteen"""
+    canteen: str = None
     day: datetime.date = None
     last_updated: datetime = None
     meals: List[Meal] = []
 
+    @property
+    def title(self) -> str:
+        """Return the header of the menu message, naming the canteen if known."""
+        canteen = f" {self.canteen}" if self.canteen else ""
+        return f"Speiseplan{canteen} für {self.day.strftime('%A, %d.%m.%Y')}:"
+
     def __str__(self) -> str:
-        plain_text = ""
-        for meal in self.meals:
-            plain_text += "\n----------\n" + str(meal)
-        return f"Speiseplan für {self.day.strftime('%A, %d.%m.%Y')}:{plain_text}"
+        plain_text = "".join("\n----------\n" + str(meal) for meal in self.meals)
+        return f"{self.title}{plain_text}"
 
     def to_html(self) -> str:
-        plain_text = ""
-        for meal in self.meals:
-            plain_text += "<hr><br><strong>" + meal.name + "</strong><br>" + meal.price
-        return f"<h3>Speiseplan für {self.day.strftime('%A, %d.%m.%Y')}:</h3>{plain_text}"
+        plain_text = "".join("<hr><br><strong>" + meal.name + "</strong><br>" + meal.price for meal in self.meals)
+        return f"<h3>{self.title}</h3>{plain_text}"
 
     def to_list(self) -> List[List]:
         result = []
@@ -36,7 +35,39 @@ class Menu:
         return result
 
     def to_dict(self) -> Dict:
-        result = {}
-        for i in range(len(self.meals)):
-            result[f'meal {i}'] = self.meals.__getitem__(i).to_dict()
-        return result
+        return {f'meal {i}': meal.to_dict() for i, meal in enumerate(self.meals)}
+
+
+@dataclass
+class MenuChanges:
+    """This class represents the changes an upsert made to the stored menu of a canteen on a day"""
+    canteen: str = None
+    day: datetime.date = None
+    new: bool = False
+    added: List[Meal] = Factory(list)
+    removed: List[Meal] = Factory(list)
+    # pairs of the stored and the incoming meal
+    price_changed: List[Tuple[Meal, Meal]] = Factory(list)
+
+    @property
+    def changed(self) -> bool:
+        return self.new or bool(self.added or self.removed or self.price_changed)
+
+
+def merge_menus(canteen: str, menu_lists: Iterable[List[Menu]]) -> List[Menu]:
+    """Merge the menus of the pages of a canteen into one menu per day.
+    Meals of the same day are concatenated in page order, the first menu of a day keeps its last_updated.
+
+    @param canteen: Canteen the pages belong to
+    @param menu_lists: Lists of menus, one list per page
+    @return: List of menus with unique days
+    """
+    merged: Dict[datetime.date, Menu] = {}
+    for menus in menu_lists:
+        for menu in menus:
+            if menu.day in merged:
+                merged[menu.day].meals.extend(menu.meals)
+            else:
+                merged[menu.day] = Menu(canteen=canteen, day=menu.day, last_updated=menu.last_updated,
+                                        meals=list(menu.meals))
+    return list(merged.values())
@@ -0,0 +1,141 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# upper bounds in seconds, from a cache hit to a slow upstream page
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, str]) -> LabelValues:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(labels: LabelValues) -> str:
+    if not labels:
+        return ""
+    escaped = (name + '="' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+               for name, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+class Counter:
+    """Monotonic counter with labels"""
+    name: str
+    documentation: str
+    _values: Dict[LabelValues, float]
+    _lock: threading.Lock
+
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self) -> List[str]:
+        # metadata and samples share the _total suffix, as in prometheus_client
+        name = f"{self.name}_total"
+        lines = [f"# HELP {name} {self.documentation}", f"# TYPE {name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return lines
+
+    def summary(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(labels)}: {value:g}" for labels, value in sorted(self._values.items())]
+
+
+class Histogram:
+    """Histogram of durations in seconds with labels"""
+    name: str
+    documentation: str
+    buckets: Tuple[float, ...]
+    # per label set: bucket counts, sum, count
+    _values: Dict[LabelValues, Tuple[List[int], float, int]]
+    _lock: threading.Lock
+
+    def __init__(self, name: str, documentation: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            index = bisect_left(self.buckets, value)
+            if index < len(counts):
+                counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def timed(self, **labels: str) -> Callable:
+        """Decorator observing the duration of every call of a coroutine function."""
+        def decorator(func: Callable) -> Callable:
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', f'{bound:g}'),))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+    def summary(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(labels)}: {count} × {total / count * 1000:.1f} ms"
+                    for labels, (counts, total, count) in sorted(self._values.items())]
+
+
+HTTP_DOWNLOAD_SECONDS = Histogram("mensabot_http_download_seconds", "Download time of upstream pages")
+PARSE_SECONDS = Histogram("mensabot_parse_seconds", "Parse time per upstream page")
+DB_QUERY_SECONDS = Histogram("mensabot_db_query_seconds", "Duration of MenuDatabase methods, including pool wait")
+COMMAND_SECONDS = Histogram("mensabot_command_seconds", "Latency of command handlers")
+SEND_SECONDS = Histogram("mensabot_send_seconds", "Latency of sending a message to a room")
+# labelled by error type only, room IDs are private and unbounded
+SEND_FAILURES = Counter("mensabot_send_failures", "Failed sends by error")
+HTTP_RETRIES = Counter("mensabot_http_retries", "Retried requests to upstream pages by host")
+HTTP_CIRCUIT_REJECTIONS = Counter("mensabot_http_circuit_rejections", "Requests rejected by an open circuit by host")
+
+METRICS = [HTTP_DOWNLOAD_SECONDS, PARSE_SECONDS, DB_QUERY_SECONDS, COMMAND_SECONDS, SEND_SECONDS, SEND_FAILURES,
+           HTTP_RETRIES, HTTP_CIRCUIT_REJECTIONS]
+
+
+def expose() -> str:
+    """Return all metrics in the Prometheus text exposition format."""
+    return "\n".join(line for metric in METRICS for line in metric.expose()) + "\n"
+
+
+def summary() -> str:
+    """Return a short human-readable overview of all metrics."""
+    return "\n".join(line for metric in METRICS for line in metric.summary())
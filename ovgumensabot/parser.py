@@ -1,30 +1,49 @@
-from datetime import datetime
-from typing import List
+import asyncio
+import hashlib
+import logging
+import re
+from concurrent.futures import Executor
+from datetime import datetime, date
+from typing import List, Optional, Tuple
 
 import bs4.element
 import pytz
-from bs4 import BeautifulSoup
+from attr import dataclass
+from bs4 import BeautifulSoup, SoupStrainer
 from maubot import Plugin
 
 from .meal import Meal
 from .menu import Menu
-
-import urllib.request
+from .metrics import HTTP_DOWNLOAD_SECONDS, PARSE_SECONDS
+from .scraper import ScraperError
 
 TZ = pytz.timezone('Europe/Berlin')
 
+# plain representation of a menu, which can be passed between processes: (day, [(name, price), ...])
+PlainMenu = Tuple[date, List[Tuple[str, str]]]
+
 
-def get_page(url: str) -> str:
-    """Return website as html string.
-    Used for debugging.
-    
+def class_strainer(css_class: str) -> SoupStrainer:
+    """Return a SoupStrainer for div elements with the given class.
+    Strainers see the unsplit class attribute while parsing, so the class is matched as a whitespace separated token.
     """
-    fp = urllib.request.urlopen(url)
-    mybytes = fp.read()
+    return SoupStrainer("div", class_=re.compile(rf"(^|\s){re.escape(css_class)}(\s|$)"))
+
+
+# only the menu tables are built into a tree, the rest of the page is skipped by the tokenizer
+MENSA_STRAINER = class_strainer("mensa")
+SEMESTER_STRAINER = class_strainer("spielplan-thisSemester")
+
 
-    page = mybytes.decode("utf8")
-    fp.close()
-    return page
+@dataclass
+class PageState:
+    """This class represents the state of a scraped page between two conditional requests"""
+    etag: str = None
+    last_modified: str = None
+    content_hash: str = None
+    menus: List[Menu] = None
+    # the last request failed and menus are those of an earlier run
+    failed: bool = False
 
 
 def get_menus_from_page(page: str) -> List[Menu]:
@@ -33,11 +52,27 @@ def get_menus_from_page(page: str) -> List[Menu]:
     @param page: Html source string
     @return: List of menus
     """
-    soup = BeautifulSoup(page, 'html.parser')
-    div_mensa = soup.find_all("div", class_="mensa")
+    return get_menus_from_fragment(get_mensa_fragment(page))
+
+
+def get_mensa_fragment(page: str) -> Optional[bs4.element.Tag]:
+    """Return the div.mensa element containing the menu tables of a given html source
 
+    @param page: Html source string
+    @return: div.mensa element or None if the page has none
+    """
+    soup = BeautifulSoup(page, 'html.parser', parse_only=MENSA_STRAINER)
+    return soup.find("div", class_="mensa")
+
+
+def get_menus_from_fragment(div_mensa: Optional[bs4.element.Tag]) -> List[Menu]:
+    """Return a list of all menus from a div.mensa element
+
+    @param div_mensa: div.mensa element (see get_mensa_fragment())
+    @return: List of menus
+    """
     if div_mensa:
-        menu_tables = div_mensa[0].find_all("table")
+        menu_tables = div_mensa.find_all("table")
     else:
         return []
 
@@ -47,22 +82,137 @@ def get_menus_from_page(page: str) -> List[Menu]:
     return menus
 
 
-async def get_menus(mensabot: Plugin, url: str) -> List[Menu]:
-    """Wrapper of get_menus_from_page() for the maubot plugin.
-    Loads webpage from url and returns a list of menus.
+def parse_menu_page(page: str, previous_hash: str = None) -> Tuple[str, Optional[List[PlainMenu]]]:
+    """Parse a canteen page into plain data, so it can run in a thread or process pool.
+
+    @param page: Html source string
+    @param previous_hash: Hash of the div.mensa fragment of the previous run, tables are not parsed if unchanged
+    @return: Hash of the div.mensa fragment and the plain menus, or None instead of the menus if unchanged
+    """
+    div_mensa = get_mensa_fragment(page)
+    content_hash = hashlib.sha256(str(div_mensa).encode()).hexdigest()
+    if content_hash == previous_hash:
+        return content_hash, None
+    # NavigableStrings reference the whole tree, they are converted to str
+    return content_hash, [(menu.day, [(_plain(meal.name), _plain(meal.price)) for meal in menu.meals])
+                          for menu in get_menus_from_fragment(div_mensa)]
+
+
+def menus_from_plain(plain_menus: List[PlainMenu]) -> List[Menu]:
+    """Return menus from the plain data of parse_menu_page()."""
+    last_updated = datetime.now(TZ)
+    return [Menu(day=day, last_updated=last_updated, meals=[Meal(name=name, price=price) for name, price in meals])
+            for day, meals in plain_menus]
+
+
+def _plain(text: Optional[str]) -> Optional[str]:
+    return None if text is None else str(text)
+
+
+async def get_menus_conditional(mensabot: Plugin, url: str, state: PageState, executor: Executor = None) -> bool:
+    """Load the menus of a canteen page with the plugin's ScraperClient, remembering ETag, Last-Modified and a hash of
+    the div.mensa fragment.
+    Parsing is skipped if the server answers 304 Not Modified or the fragment did not change.
+    While the page cannot be loaded (see ScraperClient), the menus of the previous run are kept and state.failed is set.
 
     @param mensabot: Mensabot maubot plugin
     @param url: URL string
-    @return: List of menus
+    @param state: State of the previous request, updated in place. state.menus holds the menus of the page.
+    @param executor: Thread or process pool to parse in (None for the default executor of the event loop)
+    @return: True if the menus of the page changed
+    @raise ScraperError: if the page cannot be loaded and there are no menus of a previous run
     """
-    async with mensabot.http.get(url) as resp:
-        page: str = await resp.text()
-    return get_menus_from_page(page)
+    headers = {}
+    # without menus from a previous run there is nothing to fall back to on a 304
+    if state.menus is not None:
+        if state.etag:
+            headers["If-None-Match"] = state.etag
+        if state.last_modified:
+            headers["If-Modified-Since"] = state.last_modified
+
+    try:
+        with HTTP_DOWNLOAD_SECONDS.time(url=url):
+            resp = await mensabot.scraper.get(url, headers=headers)
+    except ScraperError as e:
+        if state.menus is None:
+            raise
+        mensabot.log.warning(f"Keeping the menus of the previous fetch of {url}: {e}")
+        state.failed = True
+        return False
+    state.failed = False
+    if resp.status == 304:
+        return False
+    page = resp.text
+    state.etag = resp.headers.get("ETag")
+    state.last_modified = resp.headers.get("Last-Modified")
+
+    previous_hash = state.content_hash if state.menus is not None else None
+    with PARSE_SECONDS.time(url=url):
+        content_hash, plain_menus = await asyncio.get_running_loop().run_in_executor(
+            executor, parse_menu_page, page, previous_hash)
+    if plain_menus is None:
+        return False
+
+    state.content_hash = content_hash
+    state.menus = menus_from_plain(plain_menus)
+    return True
 
 
 def parse_table(menu_table: bs4.element.Tag) -> Menu:
     """Returns a menu from a menu_table html-source.
-    One menu includes several meals.
+    One menu includes several meals. Each row is searched for its first cell only once.
+
+    @param menu_table: html-source object
+    @return: Menu object
+    """
+    date_string = menu_table.find("thead").find("tr").find("td").string.split(',')[1].strip()
+    day = datetime.strptime(date_string, "%d.%m.%Y").date()
+    meals = []
+    for meal_element in menu_table.find("tbody").find_all("tr"):
+        cell = meal_element.find("td")
+        if cell is None:
+            logging.getLogger("maubot").debug(f"Skipping row without meal: {meal_element}")
+            continue
+        contents = cell.contents
+        if "Beilagen:" in cell.text:
+            name = contents[0]
+            price = "-"
+        elif len(contents) > 4:
+            name = contents[0].string
+            price = contents[4].string
+        else:
+            logging.getLogger("maubot").debug(f"Skipping row without meal: {meal_element}")
+            continue
+        meals.append(Meal(name=name, price=price))
+
+    return Menu(day=day,
+                last_updated=datetime.now(TZ),
+                meals=meals)
+
+
+def get_menus_from_page_reference(page: str) -> List[Menu]:
+    """Reference implementation of get_menus_from_page().
+    Builds the complete page and parses it with parse_table_reference().
+
+    @param page: Html source string
+    @return: List of menus
+    """
+    soup = BeautifulSoup(page, 'html.parser')
+    div_mensa = soup.find_all("div", class_="mensa")
+
+    if div_mensa:
+        menu_tables = div_mensa[0].find_all("table")
+    else:
+        return []
+
+    menus = []
+    for menu_table in menu_tables:
+        menus.append(parse_table_reference(menu_table))
+    return menus
+
+
+def parse_table_reference(menu_table: bs4.element.Tag) -> Menu:
+    """Reference implementation of parse_table().
 
     @param menu_table: html-source object
     @return: Menu object
@@ -79,7 +229,7 @@ def parse_table(menu_table: bs4.element.Tag) -> Menu:
                 name = meal_element.find_all("td")[0].contents[0].string
                 price = meal_element.find_all("td")[0].contents[4].string
         except IndexError:
-            print(f"IndexError on meal_element: {meal_element}")
+            logging.getLogger("maubot").debug(f"Skipping row without meal: {meal_element}")
             continue
         meal = Meal(name=name, price=price)
         meals.append(meal)
@@ -90,21 +240,35 @@ def parse_table(menu_table: bs4.element.Tag) -> Menu:
     return menu
 
 
-async def parse_movies(mensabot: Plugin, url: str) -> list[tuple[datetime, str]]:
+async def parse_movies(mensabot: Plugin, url: str, executor: Executor = None) -> list[tuple[datetime, str]]:
     """Parse hoersaal im dunkeln movie calendar → https://www.unifilm.de/studentenkinos/MD_HiD
 
     @param mensabot: Maubot plugin
     @param url: URL string
+    @param executor: Thread or process pool to parse in (None for the default executor of the event loop)
     @return: Tuples of datetime and str (date and movie-title)
     """
-    async with mensabot.http.get(url) as resp:
-        page = await resp.text()
+    with HTTP_DOWNLOAD_SECONDS.time(url=url):
+        page = (await mensabot.scraper.get(url)).text
     # mensabot.log.debug(page)
-    soup = BeautifulSoup(page, "html.parser")
+    with PARSE_SECONDS.time(url=url):
+        return await asyncio.get_running_loop().run_in_executor(executor, get_movies_from_page, page)
+
+
+def get_movies_from_page(page: str) -> list[tuple[datetime, str]]:
+    """Return the movies of the current semester from a given html source of the movie calendar.
+    Only the spielplan-thisSemester block is built into a tree.
+
+    @param page: Html source string
+    @return: Tuples of datetime and str (date and movie-title)
+    """
+    soup = BeautifulSoup(page, "html.parser", parse_only=SEMESTER_STRAINER)
 
     # locate calendar for current semester
     div_semester = soup.find(
         "div", class_="kino-detail-spielplan spielplan-thisSemester")
+    if div_semester is None:
+        return []
 
     # locate all movies in current semester
     div_movie: List[BeautifulSoup] = div_semester.find_all(
@@ -127,11 +291,3 @@ async def parse_movies(mensabot: Plugin, url: str) -> list[tuple[datetime, str]]
 
     return sorted(movies_dict.items())
 
-
-def main():
-    page = get_page('https://www.studentenwerk-magdeburg.de/mensen-cafeterien/mensa-unicampus-speiseplan-oben/')
-    menus = get_menus_from_page(page=page)
-    print(menus)
-
-if __name__ == "__main__":
-    main()
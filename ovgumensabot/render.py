@@ -0,0 +1,71 @@
+import datetime
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+
+from mautrix.types import TextMessageEventContent, MessageType, Format
+
+from ovgumensabot.menu import Menu
+
+
+class MenuRenderer:
+    """Renders the message content of a menu once per menu version and hands the same content to every send.
+    A version is identified by canteen, day and last_updated, which MenuDatabase.upsert_menu() renews whenever it
+    writes the meals of a menu.
+    The returned content is shared and must not be modified.
+    """
+    max_size: int
+    hits: int
+    misses: int
+    _contents: "OrderedDict[Tuple[str, datetime.date, datetime.datetime], TextMessageEventContent]"
+    _lock: threading.Lock
+
+    def __init__(self, max_size: int = 32) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._contents = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, menu: Menu) -> TextMessageEventContent:
+        key = (menu.canteen, menu.day, menu.last_updated)
+        with self._lock:
+            content = self._contents.get(key)
+            if content is not None:
+                self._contents.move_to_end(key)
+                self.hits += 1
+                return content
+        content = render_menu(menu)
+        with self._lock:
+            self.misses += 1
+            self._contents[key] = content
+            while len(self._contents) > self.max_size:
+                self._contents.popitem(last=False)
+        return content
+
+
+def render_menu(menu: Menu) -> TextMessageEventContent:
+    """Return the plain, html and structured message content of a menu."""
+    content = TextMessageEventContent(
+        msgtype=MessageType.NOTICE, format=Format.HTML,
+        body=str(menu),
+        formatted_body=menu.to_html())
+    content["menu"] = menu.to_dict()
+    return content
+
+
+def render_menus(menus: List[Menu], first_day: datetime.date, last_day: datetime.date) -> TextMessageEventContent:
+    """Return the content of a single compact message with the menus of the days from first_day to last_day,
+    one section per day with a menu."""
+    title = f"Speiseplan {menus[0].canteen} {first_day.strftime('%d.%m.')} - {last_day.strftime('%d.%m.%Y')}"
+    body = title + "".join(f"\n\n{menu.day.strftime('%A, %d.%m.')}:"
+                           + "".join(f"\n- {meal.name} ({meal.price})" for meal in menu.meals)
+                           for menu in menus)
+    formatted_body = f"<h3>{title}</h3>" + "".join(
+        f"<h4>{menu.day.strftime('%A, %d.%m.')}</h4><ul>"
+        + "".join(f"<li><strong>{meal.name}</strong> {meal.price}</li>" for meal in menu.meals) + "</ul>"
+        for menu in menus)
+    content = TextMessageEventContent(msgtype=MessageType.NOTICE, format=Format.HTML,
+                                      body=body, formatted_body=formatted_body)
+    content["menus"] = {menu.day.isoformat(): menu.to_dict() for menu in menus}
+    return content
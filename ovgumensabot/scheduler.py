@@ -0,0 +1,184 @@
+import asyncio
+import bisect
+import logging
+import random
+import re
+from datetime import date, datetime, time, timedelta
+from typing import Awaitable, Callable, Iterable, List, Optional
+
+import pytz
+
+from .db import AsyncMenuDatabase
+
+SCHEDULE_ENTRY = re.compile(r"(\d{1,2}):(\d{2})(?:\s*-\s*(\d{1,2}):(\d{2})\s*/\s*(\d+))?")
+
+
+def parse_schedule(entries: Iterable[str]) -> List[time]:
+    """Return the sorted times of day of schedule entries.
+    An entry is either a time "HH:MM" or a window "HH:MM-HH:MM/minutes", which runs every few minutes from the first
+    to the last time (inclusive).
+
+    @param entries: Schedule entries, e.g. ["06:30", "10:00-14:00/30"]
+    @return: Sorted unique times of day
+    @raise ValueError: if an entry cannot be parsed
+    """
+    times = set()
+    for entry in entries:
+        match = SCHEDULE_ENTRY.fullmatch(str(entry).strip())
+        if match is None:
+            raise ValueError(f"Invalid schedule entry {entry!r}, expected HH:MM or HH:MM-HH:MM/minutes")
+        first = time(int(match.group(1)), int(match.group(2)))
+        if match.group(3) is None:
+            times.add(first)
+            continue
+        last = time(int(match.group(3)), int(match.group(4)))
+        step = int(match.group(5))
+        if step <= 0 or last < first:
+            raise ValueError(f"Invalid schedule window {entry!r}")
+        minute = first.hour * 60 + first.minute
+        while minute <= last.hour * 60 + last.minute:
+            times.add(time(minute // 60, minute % 60))
+            minute += step
+    return sorted(times)
+
+
+class Schedule:
+    """Times of day at which a job runs, in a given timezone"""
+    times: List[time]
+    tz: pytz.BaseTzInfo
+
+    def __init__(self, times: List[time], tz: pytz.BaseTzInfo) -> None:
+        if not times:
+            raise ValueError("A schedule needs at least one time")
+        self.times = times
+        self.tz = tz
+
+    def _at(self, day: date, index: int) -> datetime:
+        # wrap around to the previous or next day
+        day += timedelta(days=index // len(self.times))
+        return self.tz.localize(datetime.combine(day, self.times[index % len(self.times)]))
+
+    def describe(self) -> str:
+        """Return the times of day as text, e.g. "10:00, 12:00 and 14:00"."""
+        times = [scheduled.strftime("%H:%M") for scheduled in self.times]
+        return times[0] if len(times) == 1 else f"{', '.join(times[:-1])} and {times[-1]}"
+
+    def next_after(self, moment: datetime) -> datetime:
+        """Return the first scheduled time after moment."""
+        local = moment.astimezone(self.tz)
+        return self._at(local.date(), bisect.bisect_right(self.times, local.time()))
+
+    def last_before(self, moment: datetime) -> datetime:
+        """Return the last scheduled time at or before moment."""
+        local = moment.astimezone(self.tz)
+        return self._at(local.date(), bisect.bisect_right(self.times, local.time()) - 1)
+
+
+class ScheduledJob:
+    """Runs a coroutine function on a schedule in its own task.
+    Runs never overlap, slots passing during a run are skipped. Every run is delayed by a random jitter, failed runs are
+    retried with exponential backoff until the next slot, and a slot missed while the plugin was offline is caught up
+    once on start if it is at most catch_up old. The time of the last successful run is stored in the database.
+    """
+    name: str
+    schedule: Schedule
+    func: Callable[[], Awaitable]
+    db: AsyncMenuDatabase
+    jitter: float
+    retry_delay: float
+    max_retries: int
+    catch_up: timedelta
+    task: Optional[asyncio.Task]
+    log: logging.Logger
+
+    def __init__(self, name: str, schedule: Schedule, func: Callable[[], Awaitable], db: AsyncMenuDatabase,
+                 jitter: float = 0, retry_delay: float = 300, max_retries: int = 3,
+                 catch_up: timedelta = timedelta(days=1)) -> None:
+        """
+        @param name: Unique name, used to store the last run
+        @param schedule: Times of day to run at
+        @param func: Coroutine function to run, a raised exception marks the run as failed
+        @param db: Database storing the last run
+        @param jitter: Maximum random delay of each run in seconds
+        @param retry_delay: Delay before the first retry of a failed run in seconds, doubled on every retry
+        @param max_retries: Maximum number of retries of a failed run
+        @param catch_up: Maximum age of a missed slot that is caught up on start
+        """
+        self.name = name
+        self.schedule = schedule
+        self.func = func
+        self.db = db
+        self.jitter = jitter
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+        self.catch_up = catch_up
+        self.task = None
+        self.log = logging.getLogger("maubot")
+
+    def start(self) -> asyncio.Task:
+        self.task = asyncio.ensure_future(self.run())
+        self.task.add_done_callback(self._done)
+        return self.task
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+
+    def _done(self, task: asyncio.Task) -> None:
+        # the loop catches all errors of the runs, so this only reports errors of the scheduler itself
+        if not task.cancelled() and task.exception() is not None:
+            self.log.error(f"Scheduler of {self.name} stopped", exc_info=task.exception())
+
+    async def run(self) -> None:
+        self.log.debug(f"Scheduler of {self.name} started")
+        try:
+            await self._catch_up()
+        except Exception:
+            self.log.exception(f"Failed to catch up on {self.name}")
+        while True:
+            now = datetime.now(pytz.utc)
+            scheduled_time = self.schedule.next_after(now)
+            delay = (scheduled_time - now).total_seconds() + random.uniform(0, self.jitter)
+            self.log.info(f"Scheduled {self.name} for {scheduled_time} in {delay:.0f} seconds")
+            await asyncio.sleep(delay)
+            await self.run_once()
+
+    async def _catch_up(self) -> None:
+        now = datetime.now(pytz.utc)
+        last_run = await self.db.get_job_run(self.name)
+        if last_run is None:
+            # nothing is known about missed runs on the first start
+            await self.db.set_job_run(self.name, now)
+            return
+        missed = self.schedule.last_before(now)
+        if last_run < missed and now - missed <= self.catch_up:
+            self.log.info(f"Catching up on {self.name} missed at {missed}, last run at {last_run}")
+            await self.run_once()
+
+    async def run_once(self) -> bool:
+        """Run the job, retrying on failure.
+
+        @return: True if the job succeeded
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.func()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.exception(f"Scheduled {self.name} failed (attempt {attempt + 1})")
+            else:
+                try:
+                    await self.db.set_job_run(self.name, datetime.now(pytz.utc))
+                except Exception:
+                    self.log.exception(f"Failed to store the last run of {self.name}")
+                return True
+            if attempt == self.max_retries:
+                break
+            delay = self.retry_delay * 2 ** attempt * random.uniform(0.5, 1.5)
+            now = datetime.now(pytz.utc)
+            if now + timedelta(seconds=delay) >= self.schedule.next_after(now):
+                self.log.info(f"Not retrying {self.name}, the next run is due earlier")
+                break
+            await asyncio.sleep(delay)
+        return False
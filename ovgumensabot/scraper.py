@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Dict, Mapping, Optional
+
+import aiohttp
+from attr import dataclass
+from yarl import URL
+
+from .metrics import HTTP_RETRIES, HTTP_CIRCUIT_REJECTIONS
+
+try:
+    # aiohttp decodes brotli responses if one of the brotli packages is installed
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+        ACCEPT_ENCODING = "gzip, deflate, br"
+    except ImportError:
+        ACCEPT_ENCODING = "gzip, deflate"
+
+# status codes after which the request is retried
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+USER_AGENT = "ovgumensabot (+https://github.com/v411e/ovgumensabot)"
+
+
+class ScraperError(Exception):
+    """Raised if a page could not be loaded after all retries."""
+
+
+class CircuitOpenError(ScraperError):
+    """Raised without a request while the circuit breaker of a host is open."""
+
+
+@dataclass
+class ScraperResponse:
+    """This class represents a completely read response of an upstream page"""
+    url: str = None
+    status: int = None
+    headers: Mapping[str, str] = None
+    text: str = None
+
+
+@dataclass
+class CircuitBreaker:
+    """This class represents the circuit breaker of a host.
+    The circuit opens after failure_threshold failed requests in a row and rejects requests for reset_timeout seconds.
+    Afterwards a single trial request is let through, which closes the circuit on success and opens it again on failure.
+    """
+    failure_threshold: int = 3
+    reset_timeout: float = 600
+    failures: int = 0
+    opened_at: Optional[float] = None
+    trial_running: bool = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.trial_running or time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        self.trial_running = True
+        return True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.trial_running = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class ScraperClient:
+    """HTTP client for the upstream pages with connect and read timeouts, retries with jittered exponential backoff,
+    compressed transfers and a circuit breaker per host.
+    Uses a given aiohttp session (e.g. the plugin's) to reuse its connections, or owns a session of its own.
+    """
+    session: aiohttp.ClientSession
+    timeout: aiohttp.ClientTimeout
+    max_retries: int
+    base_delay: float
+    max_delay: float
+    breakers: Dict[str, CircuitBreaker]
+
+    def __init__(self, session: aiohttp.ClientSession = None, connect_timeout: float = 10, read_timeout: float = 20,
+                 total_timeout: float = 30, max_retries: int = 3, base_delay: float = 1.0, max_delay: float = 30,
+                 failure_threshold: int = 3, reset_timeout: float = 600) -> None:
+        """
+        @param session: Session to send requests with, a new one is created and owned if None
+        @param connect_timeout: Timeout for establishing a connection in seconds
+        @param read_timeout: Timeout between two reads of the response in seconds
+        @param total_timeout: Timeout of a single attempt including reading the body in seconds
+        @param max_retries: Maximum number of retries per request
+        @param base_delay: Initial backoff in seconds, doubled on every retry
+        @param max_delay: Maximum backoff in seconds
+        @param failure_threshold: Number of failed requests in a row after which the circuit of a host opens
+        @param reset_timeout: Time in seconds until an open circuit lets a trial request through
+        """
+        self.owns_session = session is None
+        self.session = session if session is not None else aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=4, ttl_dns_cache=300))
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, sock_connect=connect_timeout,
+                                             sock_read=read_timeout)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}
+
+    async def close(self) -> None:
+        if self.owns_session:
+            await self.session.close()
+
+    def breaker(self, url: str) -> CircuitBreaker:
+        host = URL(url).host
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(failure_threshold=self.failure_threshold,
+                                                 reset_timeout=self.reset_timeout)
+        return self.breakers[host]
+
+    async def get(self, url: str, headers: Mapping[str, str] = None) -> ScraperResponse:
+        """Load a page, retrying timeouts, connection errors and RETRY_STATUSES.
+        Other client errors like 404 fail right away, redirects are followed and 304 Not Modified is returned.
+
+        @param url: URL string
+        @param headers: Additional request headers
+        @return: ScraperResponse
+        @raise CircuitOpenError: if the circuit breaker of the host is open
+        @raise ScraperError: if all attempts failed
+        """
+        breaker = self.breaker(url)
+        if not breaker.allow():
+            HTTP_CIRCUIT_REJECTIONS.inc(host=URL(url).host)
+            raise CircuitOpenError(f"Circuit for {URL(url).host} is open after {breaker.failures} failures")
+        headers = {"Accept-Encoding": ACCEPT_ENCODING, "User-Agent": USER_AGENT, **(headers or {})}
+        attempt = 0
+        try:
+            while True:
+                retry_after = None
+                try:
+                    async with self.session.get(url, headers=headers, timeout=self.timeout) as resp:
+                        if resp.status not in RETRY_STATUSES:
+                            text = await resp.text()
+                            # the host answered, so a client error does not count against its circuit
+                            breaker.record_success()
+                            if resp.status >= 400:
+                                raise ScraperError(f"Failed to load {url}: HTTP {resp.status}")
+                            return ScraperResponse(url=url, status=resp.status, headers=resp.headers, text=text)
+                        error = f"HTTP {resp.status}"
+                        retry_after = resp.headers.get("Retry-After")
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = f"{type(e).__name__}: {e}"
+                if attempt >= self.max_retries:
+                    breaker.record_failure()
+                    raise ScraperError(f"Failed to load {url} after {attempt + 1} attempts: {error}")
+                HTTP_RETRIES.inc(host=URL(url).host)
+                delay = self.backoff(attempt, retry_after)
+                logging.getLogger("maubot").warning(f"Loading {url} failed ({error}), "
+                                                    f"retrying in {delay:.1f} seconds")
+                await asyncio.sleep(delay)
+                attempt += 1
+        except BaseException:
+            # e.g. cancelled, a trial request must not keep the circuit open forever
+            breaker.trial_running = False
+            raise
+
+    def backoff(self, attempt: int, retry_after: str = None) -> float:
+        """Return the delay before the next attempt, a Retry-After in seconds is respected up to max_delay."""
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.max_delay)
+        # full jitter, so concurrent requests do not retry in lockstep
+        return random.uniform(0, min(self.base_delay * 2 ** attempt, self.max_delay))
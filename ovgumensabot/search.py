@@ -0,0 +1,121 @@
+import bisect
+import datetime
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from attr import dataclass, Factory
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+
+def trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+@dataclass
+class SearchResult:
+    """This class represents the days a canteen served meals matching a search term"""
+    term: str = None
+    canteen: str = None
+    # days with a matching meal, ascending
+    days: List[datetime.date] = Factory(list)
+    # matching meal names by day
+    meals: Dict[datetime.date, List[str]] = Factory(dict)
+
+    def next_day(self, from_day: datetime.date) -> Optional[datetime.date]:
+        """Return the first day on or after from_day with a matching meal, or None."""
+        i = bisect.bisect_left(self.days, from_day)
+        return self.days[i] if i < len(self.days) else None
+
+    def last_day(self, before: datetime.date) -> Optional[datetime.date]:
+        """Return the last day before a given day with a matching meal, or None."""
+        i = bisect.bisect_left(self.days, before)
+        return self.days[i - 1] if i > 0 else None
+
+    def count_between(self, first_day: datetime.date, last_day: datetime.date) -> int:
+        """Return the number of days from first_day to last_day (inclusive) with a matching meal."""
+        return bisect.bisect_right(self.days, last_day) - bisect.bisect_left(self.days, first_day)
+
+
+class MealIndex:
+    """In-memory trigram index over the meal names of all stored menus.
+    Any substring of three or more characters is looked up by intersecting the postings of its trigrams,
+    so compound names like "Jägerschnitzel" are found by "schnitzel" without scanning all meals.
+    The index is built from the database on first use and kept up to date by MenuDatabase afterwards.
+    Adding and removing are idempotent, so updates racing with the initial build are safe.
+    """
+    loaded: bool
+    _names: Dict[str, str]
+    _postings: Dict[str, Set[str]]
+    _days: Dict[str, Dict[str, Set[datetime.date]]]
+    _lock: threading.Lock
+
+    def __init__(self) -> None:
+        self.loaded = False
+        # display name by normalized name
+        self._names = {}
+        # normalized names by trigram
+        self._postings = defaultdict(set)
+        # days served by normalized name and canteen
+        self._days = defaultdict(lambda: defaultdict(set))
+        self._lock = threading.Lock()
+
+    def load(self, rows: Callable[[], Iterable[Tuple[str, datetime.date, str]]]) -> None:
+        """Build the index from (canteen, day, name) rows unless it is loaded already.
+
+        @param rows: Function returning the rows, called while updates wait for the build
+        """
+        with self._lock:
+            if self.loaded:
+                return
+            for canteen, day, name in rows():
+                self._add(canteen, day, name)
+            self.loaded = True
+
+    def add(self, canteen: str, day: datetime.date, names: Iterable[str]) -> None:
+        with self._lock:
+            if self.loaded:
+                for name in names:
+                    self._add(canteen, day, name)
+
+    def remove(self, canteen: str, day: datetime.date, names: Iterable[str]) -> None:
+        with self._lock:
+            if self.loaded:
+                for name in names:
+                    key = normalize(name)
+                    if key in self._days:
+                        self._days[key][canteen].discard(day)
+
+    def remove_before(self, before: datetime.date) -> None:
+        """Remove all days before a given day, as done when pruning old menus."""
+        with self._lock:
+            if self.loaded:
+                for days_by_canteen in self._days.values():
+                    for canteen, days in days_by_canteen.items():
+                        days_by_canteen[canteen] = {day for day in days if day >= before}
+
+    def _add(self, canteen: str, day: datetime.date, name: str) -> None:
+        key = normalize(name)
+        if key not in self._names:
+            self._names[key] = name
+            for trigram in trigrams(key):
+                self._postings[trigram].add(key)
+        self._days[key][canteen].add(day)
+
+    def search(self, term: str, canteen: str) -> SearchResult:
+        """Return the days a canteen served meals whose name contains the term, ignoring case."""
+        term = normalize(term)
+        with self._lock:
+            grams = sorted((self._postings.get(trigram, set()) for trigram in trigrams(term)), key=len)
+            # terms shorter than three characters have no trigrams and are checked against every name
+            candidates = set.intersection(*grams) if grams else self._names.keys()
+            names_by_day = defaultdict(list)
+            for key in candidates:
+                if term in key:
+                    for day in self._days[key].get(canteen, ()):
+                        names_by_day[day].append(self._names[key])
+        return SearchResult(term=term, canteen=canteen, days=sorted(names_by_day),
+                            meals={day: sorted(names) for day, names in names_by_day.items()})
@@ -0,0 +1,77 @@
+import asyncio
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from ovgumensabot.db import AsyncMenuDatabase
+
+
+class SubscriptionRegistry:
+    """In-memory copy of the subscriptions table, mapping room IDs to the canteen they are subscribed to.
+    Loaded once and written through to the database on every change, so lookups and the rooms of a fan-out
+    need no query. The database is written first, a failed write leaves the registry unchanged.
+    """
+    db: AsyncMenuDatabase
+    _canteens: Dict[str, str]
+    _lock: asyncio.Lock
+
+    def __init__(self, db: AsyncMenuDatabase) -> None:
+        self.db = db
+        self._canteens = {}
+        self._lock = asyncio.Lock()
+
+    async def load(self, subscriptions: Iterable[Tuple[str, str]] = None) -> None:
+        """Load the subscriptions from the database.
+
+        @param subscriptions: (room_id, canteen) pairs already read from the database, e.g. by warm_start
+        """
+        if subscriptions is None:
+            subscriptions = await self.db.get_all_subscriptions()
+        self._canteens = dict(subscriptions)
+
+    def __contains__(self, room_id: str) -> bool:
+        return room_id in self._canteens
+
+    def __len__(self) -> int:
+        return len(self._canteens)
+
+    def get(self, room_id: str) -> Optional[str]:
+        """Return the canteen a room is subscribed to, or None."""
+        return self._canteens.get(room_id)
+
+    def rooms(self, canteen: str = None) -> List[str]:
+        """Return the room IDs of all subscriptions, or of the subscriptions of one canteen."""
+        return [room_id for room_id, subscribed in self._canteens.items() if canteen in (None, subscribed)]
+
+    async def add(self, room_id: str, canteen: str) -> None:
+        """Subscribe a room to a canteen, replacing its previous canteen."""
+        async with self._lock:
+            if room_id in self._canteens:
+                await self.db.update_subscription(room_id, canteen)
+            else:
+                await self.db.insert_subscription(room_id, canteen)
+            self._canteens[room_id] = canteen
+
+    async def remove(self, room_id: str) -> None:
+        async with self._lock:
+            await self.db.delete_subscription(room_id)
+            self._canteens.pop(room_id, None)
+
+    async def add_many(self, subscriptions: Dict[str, str]) -> None:
+        """Subscribe many rooms with one insert and one update per canteen.
+
+        @param subscriptions: Canteens by room ID
+        """
+        async with self._lock:
+            new = {room_id: canteen for room_id, canteen in subscriptions.items() if room_id not in self._canteens}
+            changed = {room_id: canteen for room_id, canteen in subscriptions.items()
+                       if room_id in self._canteens and self._canteens[room_id] != canteen}
+            await self.db.insert_subscriptions(list(new.items()))
+            await self.db.update_subscriptions(list(changed.items()))
+            self._canteens.update(subscriptions)
+
+    async def remove_many(self, room_ids: Iterable[str]) -> None:
+        """Unsubscribe many rooms with batched deletes."""
+        async with self._lock:
+            room_ids = [room_id for room_id in set(room_ids) if room_id in self._canteens]
+            await self.db.delete_subscriptions(room_ids)
+            for room_id in room_ids:
+                del self._canteens[room_id]